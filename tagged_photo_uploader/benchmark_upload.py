@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Benchmarks the uploader against the fake LocalWiki API server with a
+generated set of tagged photos and reports the throughput, the time spent
+in each stage and the number of API calls."""
+
+# standard library
+import os
+import time
+import random
+import shutil
+import tempfile
+
+# external libraries
+from gi.repository import GExiv2
+from PIL import Image, ImageDraw
+
+# local libraries
+from upload_tagged_photos import ImageUploader
+from fake_localwiki import FakeLocalWiki
+
+
+def generate_photos(directory, main_keyword, num_images, num_pages,
+                    widths=(640, 1024, 2048, 4000), seed=0):
+    """Writes JPEG photos tagged for the pages Page 0, Page 1, ... into the
+    directory, with a mix of sizes and orientations, and returns the total
+    number of bytes written.
+
+    Parameters
+    ==========
+    directory : string
+        The directory to write the photos in.
+    main_keyword : string
+        The keyword that marks the photos for the wiki.
+    num_images : integer
+        The number of photos.
+    num_pages : integer
+        The number of pages the photos are spread over.
+    widths : sequence of integers, optional
+        The widths to choose from, the photos have a 4:3 aspect ratio.
+    seed : integer, optional, default=0
+        The seed for choosing the sizes, orientations and colors.
+
+    """
+    rand = random.Random(seed)
+    total_bytes = 0
+
+    for i in range(num_images):
+        width = rand.choice(widths)
+        height = width * 3 // 4
+        image = Image.new('RGB', (width, height), tuple(
+            rand.randrange(256) for _ in range(3)))
+        draw = ImageDraw.Draw(image)
+        for _ in range(10):
+            x, y = rand.randrange(width), rand.randrange(height)
+            draw.ellipse([x, y, x + width // 8, y + height // 8],
+                         fill=tuple(rand.randrange(256) for _ in range(3)))
+
+        file_path = os.path.join(directory, 'photo-{:05d}.jpg'.format(i))
+        image.save(file_path, quality=90)
+
+        metadata = GExiv2.Metadata(file_path)
+        metadata.set_tag_multiple('Iptc.Application2.Keywords',
+                                  [main_keyword, 'page:Page {}'.format(
+                                      i % num_pages)])
+        metadata['Exif.Image.Orientation'] = rand.choice(['1', '3', '6',
+                                                          '8'])
+        metadata['Iptc.Application2.Caption'] = 'Photo {}'.format(i)
+        metadata.save_file()
+
+        total_bytes += os.path.getsize(file_path)
+
+    return total_bytes
+
+
+def run_benchmark(num_images=100, num_pages=10, latency=0.02,
+                  error_rate=0.0, processes=1, concurrency=1,
+                  in_memory=False, retries=5, memory_budget=None,
+                  derivative_widths=(), seed=0):
+    """Uploads a generated set of photos to a fake wiki, prints a report
+    and returns the number of seconds the upload took."""
+
+    main_keyword = 'benchmark wiki'
+    directory = tempfile.mkdtemp(prefix='benchmark-photos-')
+
+    try:
+        print('Generating {} photos for {} pages...'.format(num_images,
+                                                             num_pages))
+        total_bytes = generate_photos(directory, main_keyword, num_images,
+                                      num_pages, seed=seed)
+
+        with FakeLocalWiki(latency=latency, error_rate=error_rate,
+                           seed=seed) as wiki:
+
+            uploader = ImageUploader(wiki.api_url, user_name='benchmark',
+                                     api_key='benchmark', retries=retries)
+
+            start = time.time()
+            uploader.upload(main_keyword, directory, processes=processes,
+                            concurrency=concurrency, in_memory=in_memory,
+                            memory_budget=memory_budget,
+                            derivative_widths=list(derivative_widths))
+            duration = time.time() - start
+
+        lines = ['',
+                 'images: {}, pages: {}, latency: {} s, error rate: {}, '
+                 'processes: {}, concurrency: {}, in memory: {}, '
+                 'derivatives: {}'.format(
+                     num_images, num_pages, latency, error_rate, processes,
+                     concurrency, in_memory, list(derivative_widths)),
+                 'duration: {:.2f} s, {:.2f} images/s, {:.2f} MB/s read'.format(
+                     duration, num_images / duration,
+                     total_bytes / duration / 1e6),
+                 'pages created: {}, files uploaded: {}, '
+                 '{:.2f} MB received'.format(len(wiki.pages),
+                                             len(wiki.files),
+                                             wiki.bytes_received / 1e6),
+                 '']
+        lines.append(uploader.metrics.report())
+        lines.extend(['', '{:<28}{:>8}'.format('server side api call',
+                                                 'calls')])
+        for (method, endpoint, status), count in sorted(wiki.calls.items()):
+            lines.append('{:<28}{:>8}'.format('{} {} {}'.format(
+                method, endpoint, status), count))
+        lines.append('{:<28}{:>8}'.format('total',
+                                          sum(wiki.calls.values())))
+
+        for line in lines:
+            print(line)
+
+        return duration
+
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description='Benchmarks the uploader against a fake LocalWiki API.')
+    parser.add_argument('-n', '--images', type=int, default=100,
+                        help='The number of photos to generate.')
+    parser.add_argument('-m', '--pages', type=int, default=10,
+                        help='The number of pages the photos belong to.')
+    parser.add_argument('-l', '--latency', type=float, default=0.02,
+                        help='The seconds the fake server takes per request.')
+    parser.add_argument('-e', '--error-rate', type=float, default=0.0,
+                        help='The share of requests that fail with a 503.')
+    parser.add_argument('-p', '--processes', type=int, default=1,
+                        help='The number of processes preparing images.')
+    parser.add_argument('-c', '--concurrency', type=int, default=1,
+                        help='The number of concurrent uploads.')
+    parser.add_argument('--in-memory', action='store_true',
+                        help='Keep the prepared images in memory.')
+    parser.add_argument('--retries', type=int, default=5,
+                        help='The retries of failed requests.')
+    parser.add_argument('--memory-budget', type=int, default=None,
+                        help='The megabytes of decoded images per process.')
+    parser.add_argument('--derivative-width', type=int, action='append',
+                        default=[],
+                        help='Also upload copies this wide, can be repeated.')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='The seed for the photos and failures.')
+    args = parser.parse_args()
+
+    run_benchmark(num_images=args.images, num_pages=args.pages,
+                  latency=args.latency, error_rate=args.error_rate,
+                  processes=args.processes, concurrency=args.concurrency,
+                  in_memory=args.in_memory, retries=args.retries,
+                  memory_budget=args.memory_budget,
+                  derivative_widths=args.derivative_width, seed=args.seed)
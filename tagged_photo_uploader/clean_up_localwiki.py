@@ -1,35 +1,346 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-"""This script should be run on the server to wipe out everything from the
-tests."""
+"""This script should be run on the server to wipe out the pages and files
+left by the tests or by an upload, along with their version history. It
+must be run with the Python of the localwiki install, e.g.::
 
-from pages.models import PageFile, Page
+    $ python clean_up_localwiki.py --page 'Test *' --dry-run
 
-# Delete any blank pages cause by the api bug
-# https://github.com/localwiki/localwiki/issues/616
+With no options it deletes the pages made by the tests. Unless --yes or
+--dry-run is given, it asks before deleting anything. The pages and files
+are deleted with batched querysets, each batch in a transaction, so large
+imports are removed in a few queries per thousand objects."""
+
+# standard library
+import os
+import re
+import json
+import sqlite3
+import datetime
 try:
-    page = PageFile.objects.get(name='')
-except PageFile.DoesNotExist:
+    input = raw_input
+except NameError:  # Python 3
     pass
-else:
-    for version in page.versions.all():
-        version.delete()
-    page.delete(track_changes=False)
 
-# Delete all existence of the three test pages.
+# The settings module of localwiki, needed before the models are imported.
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'sapling.settings')
+
+import django
+from django.db import transaction
+from django.db.models import Min
+
+if hasattr(django, 'setup'):
+    django.setup()
+
+from pages.models import PageFile, Page, slugify
+
+# The pages made by the tests, and the blank page caused by the api bug
+# https://github.com/localwiki/localwiki/issues/616
 test_page_names = ['Existing Upload Test Page',
                    'Non Existing Upload Test Page',
-                   'This Page Does Not Exist']
-for page_name in test_page_names:
+                   'This Page Does Not Exist',
+                   '']
+
+# The number of pages or files deleted in each transaction.
+batch_size = 500
+
+
+def atomic():
+    """Returns a context manager that runs its block in a transaction."""
+    if hasattr(transaction, 'atomic'):
+        return transaction.atomic()
+    return transaction.commit_on_success()
+
+
+def glob_to_regex(pattern):
+    """Returns a database regular expression that matches the whole of a
+    name against a glob pattern, where * matches any characters and ?
+    matches one."""
+
+    parts = []
+    for character in pattern:
+        if character == '*':
+            parts.append('.*')
+        elif character == '?':
+            parts.append('.')
+        else:
+            parts.append(re.escape(character))
+
+    return '^' + ''.join(parts) + '$'
+
+
+def _batches(items, size):
+    """Yields lists of up to size of the sorted items."""
+    items = sorted(items)
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def select_pages(patterns=(), since=None, until=None, user_name=None):
+    """Returns the set of slugs of the pages whose names match any of the
+    glob patterns or, if since or until is given, that were created in that
+    date range, by user_name if it is given.
+
+    Parameters
+    ==========
+    patterns : list of strings, optional
+        Glob patterns for the page names.
+    since : datetime.datetime, optional, default=None
+        The earliest creation time of the pages.
+    until : datetime.datetime, optional, default=None
+        The creation time the pages must be earlier than.
+    user_name : string, optional, default=None
+        Only the pages created by this user are selected by date.
+
+    """
+
+    slugs = set()
+
+    for pattern in patterns:
+        slugs.update(Page.objects.filter(
+            name__regex=glob_to_regex(pattern)).values_list('slug',
+                                                            flat=True))
+
+    if since is not None or until is not None:
+        # A page is created by its first version.
+        versions = Page.versions.values('slug').annotate(
+            created=Min('history_date'))
+        if since is not None:
+            versions = versions.filter(created__gte=since)
+        if until is not None:
+            versions = versions.filter(created__lt=until)
+        created = set(version['slug'] for version in versions)
+
+        if user_name is not None:
+            creators = {}
+            for batch in _batches(created, batch_size):
+                for slug, creator in Page.versions.filter(
+                        slug__in=batch).order_by(
+                            '-history_date').values_list(
+                                'slug', 'history_user__username'):
+                    # The first version comes last.
+                    creators[slug] = creator
+            created = set(slug for slug in created if creators.get(slug) ==
+                          user_name)
+
+        slugs.update(created)
+
+    return slugs
+
+
+def _hash_index_rows(connection, query):
+    """Returns the rows of the query on a hash index, none if the index
+    was written by a version of upload_tagged_photos.py without the
+    table."""
+
     try:
-        page = Page.objects.get(name=page_name)
-    except Page.DoesNotExist:
-        pass
+        return connection.execute(query).fetchall()
+    except sqlite3.OperationalError:
+        return []
+
+
+def select_files(patterns=(), hash_index_path=None, plan_path=None):
+    """Returns a dictionary mapping page slugs to the sets of names of the
+    files to delete from them, and the set of slugs of the pages the
+    uploader created, which are deleted too.
+
+    Parameters
+    ==========
+    patterns : list of strings, optional
+        Glob patterns for the file names.
+    hash_index_path : string, optional, default=None
+        The path to the hash index of the uploads, i.e. the --hash-index
+        SQLite file of upload_tagged_photos.py. The files and pages it
+        records the uploader posted are selected, not the files that were
+        on the wiki before.
+    plan_path : string, optional, default=None
+        The path to a plan written by upload_tagged_photos.py --plan. The
+        files it would upload are selected. Its pages aren't, as a page
+        the plan expected to create may have been made by someone else
+        since.
+
+    """
+
+    files = {}
+    created_pages = set()
+
+    for pattern in patterns:
+        for slug, name in PageFile.objects.filter(
+                name__regex=glob_to_regex(pattern)).values_list('slug',
+                                                                'name'):
+            files.setdefault(slug, set()).add(name)
+
+    if hash_index_path is not None:
+        connection = sqlite3.connect(hash_index_path)
+        try:
+            for slug, name in _hash_index_rows(
+                    connection, "SELECT slug, name FROM posted"):
+                files.setdefault(slug, set()).add(name)
+            created_pages.update(row[0] for row in _hash_index_rows(
+                connection, "SELECT slug FROM created"))
+        finally:
+            connection.close()
+
+    if plan_path is not None:
+        with open(plan_path) as f:
+            plan = json.load(f)
+        for image in plan['images']:
+            if image['action'] == 'upload':
+                files.setdefault(slugify(image['page']), set()).add(
+                    image['name'])
+
+    return files, created_pages
+
+
+def delete_pages(slugs, dry_run=False):
+    """Deletes the pages, the files on them and the history of both, a
+    batch of pages per transaction. Returns the numbers of pages, files
+    and versions deleted, or that would be if dry_run is true."""
+
+    counts = [0, 0, 0]
+
+    for batch in _batches(slugs, batch_size):
+        with atomic():
+            pages = Page.objects.filter(slug__in=batch)
+            files = PageFile.objects.filter(slug__in=batch)
+            # The history is deleted last, deleting the pages and files
+            # records versions for the deletions.
+            querysets = [pages, files, Page.versions.filter(slug__in=batch),
+                         PageFile.versions.filter(slug__in=batch)]
+
+            numbers = [queryset.count() for queryset in querysets]
+            counts[0] += numbers[0]
+            counts[1] += numbers[1]
+            counts[2] += numbers[2] + numbers[3]
+
+            if not dry_run:
+                for queryset in querysets:
+                    queryset.delete()
+
+    return counts
+
+
+def delete_files(files, dry_run=False):
+    """Deletes the files, given as a dictionary mapping page slugs to sets
+    of file names, and their history, a batch of pages per transaction.
+    Returns the numbers of files and versions deleted, or that would be if
+    dry_run is true."""
+
+    counts = [0, 0]
+
+    for batch in _batches(files.keys(), batch_size):
+        with atomic():
+            for slug in batch:
+                names = sorted(files[slug])
+                querysets = [
+                    PageFile.objects.filter(slug=slug, name__in=names),
+                    PageFile.versions.filter(slug=slug, name__in=names)]
+
+                numbers = [queryset.count() for queryset in querysets]
+                counts[0] += numbers[0]
+                counts[1] += numbers[1]
+
+                if not dry_run:
+                    for queryset in querysets:
+                        queryset.delete()
+
+    return counts
+
+
+def parse_date(text):
+    """Returns the datetime of a YYYY-MM-DD date or YYYY-MM-DDTHH:MM
+    time."""
+
+    for date_format in ('%Y-%m-%d', '%Y-%m-%dT%H:%M'):
+        try:
+            return datetime.datetime.strptime(text, date_format)
+        except ValueError:
+            pass
+
+    raise ValueError("Can't read the date {}.".format(text))
+
+
+if __name__ == "__main__":
+
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description='Delete pages and files from a localwiki in bulk.')
+
+    parser.add_argument('--page', type=str, action='append', default=[],
+        help="Delete the pages matching this glob, can be repeated.")
+
+    parser.add_argument('--file', type=str, action='append', default=[],
+        help="Delete the files matching this glob, can be repeated.")
+
+    parser.add_argument('--hash-index', type=str, default=None,
+        help="Delete the files and pages this upload hash index records "
+             "the uploader posted.")
+
+    parser.add_argument('--plan', type=str, default=None,
+        help="Delete the files this upload plan would upload.")
+
+    parser.add_argument('--since', type=parse_date, default=None,
+        help="Delete the pages created at or after this date.")
+
+    parser.add_argument('--until', type=parse_date, default=None,
+        help="Delete the pages created before this date.")
+
+    parser.add_argument('--user', type=str, default=None,
+        help="Only delete the pages by date that this user created.")
+
+    parser.add_argument('--dry-run', action='store_true',
+        help="Only count what would be deleted.")
+
+    parser.add_argument('--yes', action='store_true',
+        help="Delete without asking first.")
+
+    args = parser.parse_args()
+
+    if args.user and not (args.since or args.until):
+        parser.error("--user needs --since or --until.")
+
+    if not (args.page or args.file or args.hash_index or args.plan or
+            args.since or args.until):
+        page_slugs = set(Page.objects.filter(
+            name__in=test_page_names).values_list('slug', flat=True))
+        # Blank file names are caused by the same bug.
+        files, created_pages = select_files([''])
     else:
-        for version in page.versions.all():
-            version.delete()
-        page.delete(track_changes=False)
+        page_slugs = select_pages(args.page, args.since, args.until,
+                                  args.user)
+        files, created_pages = select_files(args.file, args.hash_index,
+                                            args.plan)
+        page_slugs.update(created_pages)
+
+    # The files on deleted pages go with them.
+    files = dict((slug, names) for slug, names in files.items() if slug not
+                 in page_slugs)
+
+    def delete(dry_run):
+        """Deletes, or counts, the selected pages and files."""
 
-# TODO : This still isn't wiping the page history instance. I need to figure
-# out how to do that.
+        if dry_run:
+            verb = 'Would delete'
+        else:
+            verb = 'Deleted'
+
+        pages, page_files, page_versions = delete_pages(page_slugs, dry_run)
+        print("{} {} pages with {} files and {} versions.".format(
+            verb, pages, page_files, page_versions))
+
+        file_count, file_versions = delete_files(files, dry_run)
+        print("{} {} more files and {} versions.".format(verb, file_count,
+                                                         file_versions))
+
+    if args.dry_run:
+        delete(True)
+    elif args.yes:
+        delete(False)
+    else:
+        delete(True)
+        if input("Delete them? [y/N] ").strip().lower() in ('y', 'yes'):
+            delete(False)
+        else:
+            print("Nothing was deleted.")
@@ -0,0 +1,316 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""An in-process fake of the page and file endpoints of the LocalWiki API,
+so the uploader can be tested and benchmarked without a live wiki. It can
+add latency to every request and fail a share of them on purpose."""
+
+# standard library
+import re
+import json
+import time
+import random
+import threading
+import collections
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse, parse_qs
+    from urllib import unquote
+except ImportError:  # Python 3
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qs, unquote
+
+
+def _parse_multipart(body, content_type):
+    """Returns a dictionary mapping the field names of a multipart/form-data
+    body to their raw values."""
+
+    boundary = content_type.split('boundary=')[1].strip('"')
+
+    fields = {}
+    for part in body.split(b'--' + boundary.encode('ascii')):
+        head, separator, value = part.partition(b'\r\n\r\n')
+        name = re.search(b'name="([^"]*)"', head)
+        if separator and name is not None:
+            # Each value is followed by the line break before the boundary.
+            fields[name.group(1).decode('utf-8')] = value[:-2]
+
+    return fields
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _Handler(BaseHTTPRequestHandler):
+    """Hands every request to the FakeLocalWiki of the server."""
+
+    def _handle(self):
+        url = urlparse(self.path)
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+
+        status, response = self.server.wiki.handle(
+            self.command, url.path, parse_qs(url.query),
+            self.headers.get('Content-Type', ''), body)
+
+        self.send_response(status)
+        if response is None:
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+        else:
+            data = json.dumps(response).encode('utf-8')
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+    do_GET = do_POST = do_PATCH = do_PUT = do_DELETE = _handle
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeLocalWiki(object):
+    """A fake LocalWiki API server that runs in a thread of this process.
+    Pages and files are kept in memory, the file contents are only
+    counted unless keep_contents is set. Every request is recorded in calls by method, endpoint and
+    status, e.g. calls[('GET', 'page', 200)].
+
+    Use it as a context manager, or call start and stop::
+
+        with FakeLocalWiki(latency=0.05) as wiki:
+            uploader = ImageUploader(wiki.api_url, user_name='user',
+                                     api_key='key')
+
+    """
+
+    _default_limit = 20
+
+    def __init__(self, latency=0.0, error_rate=0.0, error_status=503,
+                 seed=None, keep_contents=False):
+        """Initializes an empty wiki, the server isn't started yet.
+
+        Parameters
+        ==========
+        latency : float, optional, default=0.0
+            The number of seconds every request takes before it is
+            answered.
+        error_rate : float, optional, default=0.0
+            The share of the requests, from 0 to 1, that fail with
+            error_status instead of being handled.
+        error_status : integer, optional, default=503
+            The HTTP status of the injected failures.
+        seed : integer, optional, default=None
+            The seed for choosing which requests fail.
+        keep_contents : boolean, optional, default=False
+            If true, the contents of the uploaded files are kept in
+            contents by file id, e.g. to check what a test uploaded.
+
+        """
+        self.latency = latency
+        self.keep_contents = keep_contents
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server = None
+        self.reset()
+
+    def reset(self):
+        """Removes all the pages and files and clears the counters."""
+
+        self.pages = collections.OrderedDict()
+        self.files = collections.OrderedDict()
+        self.contents = {}
+        self.calls = collections.Counter()
+        self.bytes_received = 0
+        self._next_file_id = 1
+
+    def start(self):
+        """Starts serving on a free port of the loopback interface."""
+
+        self._server = _ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+        self._server.wiki = self
+        thread = threading.Thread(target=self._server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+        return self
+
+    def stop(self):
+        """Stops the server."""
+
+        self._server.shutdown()
+        self._server.server_close()
+        self._server = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    @property
+    def api_url(self):
+        """The URL of the API, with a trailing slash."""
+        return 'http://127.0.0.1:{}/api/'.format(
+            self._server.server_address[1])
+
+    @staticmethod
+    def slugify(name):
+        """Returns the slug of a page name, lower case with runs of spaces
+        and underscores made a single space."""
+        return ' '.join(name.replace('_', ' ').split()).lower()
+
+    def add_page(self, name, content='<p></p>'):
+        """Creates a page directly and returns its dictionary."""
+
+        with self._lock:
+            return self._add_page(name, content)
+
+    def _add_page(self, name, content):
+        slug = self.slugify(name)
+        page = {'name': name, 'slug': slug, 'content': content,
+                'resource_uri': '/api/page/{}'.format(slug)}
+        self.pages[slug] = page
+        return page
+
+    def add_file(self, name, slug, size=0):
+        """Attaches a file to a page directly and returns its
+        dictionary."""
+
+        with self._lock:
+            return self._add_file(name, slug, size)
+
+    def _add_file(self, name, slug, size):
+        file_id = self._next_file_id
+        self._next_file_id += 1
+        file_dict = {'id': file_id, 'name': name, 'slug': slug,
+                     'size': size,
+                     'resource_uri': '/api/file/{}'.format(file_id)}
+        self.files[file_id] = file_dict
+        return file_dict
+
+    def handle(self, method, path, query, content_type, body):
+        """Answers a request, returns the status and the response
+        dictionary, or None for an empty body."""
+
+        if self.latency:
+            time.sleep(self.latency)
+
+        parts = path.split('/api/', 1)[-1].split('/', 1)
+        endpoint = parts[0]
+        rest = unquote(parts[1]) if len(parts) > 1 else ''
+
+        with self._lock:
+            if self.error_rate and self._random.random() < self.error_rate:
+                status, response = self.error_status, None
+            elif endpoint == 'page':
+                status, response = self._handle_page(method, rest, query,
+                                                     body)
+            elif endpoint == 'file':
+                status, response = self._handle_file(method, rest, query,
+                                                     content_type, body)
+            else:
+                status, response = 404, None
+
+            self.bytes_received += len(body)
+            self.calls[(method, endpoint, status)] += 1
+
+        return status, response
+
+    def _handle_page(self, method, name, query, body):
+
+        slug = self.slugify(name)
+
+        if method == 'GET' and name:
+            if slug in self.pages:
+                return 200, self.pages[slug]
+            return 404, None
+        elif method == 'GET':
+            pages = list(self.pages.values())
+            if 'name' in query:
+                pages = [page for page in pages if page['name'] ==
+                         query['name'][0]]
+            if 'name__in' in query:
+                names = query['name__in'][0].split(',')
+                pages = [page for page in pages if page['name'] in names]
+            if 'slug__in' in query:
+                slugs = query['slug__in'][0].split(',')
+                pages = [page for page in pages if page['slug'] in slugs]
+            return 200, self._listing(pages, query)
+        elif method == 'POST':
+            page_dict = json.loads(body.decode('utf-8'))
+            if not page_dict.get('name'):
+                return 400, None
+            self._add_page(page_dict['name'], page_dict.get('content', ''))
+            # LocalWiki answers creations with an empty body.
+            return 201, None
+        elif method in ('PATCH', 'PUT'):
+            if slug not in self.pages:
+                return 404, None
+            changes = json.loads(body.decode('utf-8'))
+            self.pages[slug].update(
+                (key, value) for key, value in changes.items() if key in
+                ('content', 'name'))
+            return 202, None
+        elif method == 'DELETE':
+            if self.pages.pop(slug, None) is None:
+                return 404, None
+            return 204, None
+
+        return 405, None
+
+    def _handle_file(self, method, file_id, query, content_type, body):
+
+        if method == 'GET' and file_id:
+            if int(file_id) in self.files:
+                return 200, self.files[int(file_id)]
+            return 404, None
+        elif method == 'GET':
+            files = [file_dict for file_dict in self.files.values() if
+                     all(file_dict.get(key) == query[key][0] for key in
+                         ('name', 'slug') if key in query)]
+            return 200, self._listing(files, query)
+        elif method == 'POST':
+            fields = _parse_multipart(body, content_type)
+            slug = fields.get('slug', b'').decode('utf-8')
+            if slug not in self.pages or 'file' not in fields:
+                return 400, None
+            file_dict = self._add_file(fields['name'].decode('utf-8'), slug,
+                                       len(fields['file']))
+            if self.keep_contents:
+                self.contents[file_dict['id']] = fields['file']
+            return 201, None
+        elif method == 'DELETE':
+            if self.files.pop(int(file_id), None) is None:
+                return 404, None
+            self.contents.pop(int(file_id), None)
+            return 204, None
+
+        return 405, None
+
+    def _listing(self, objects, query):
+        """Returns a page of a listing the way Tastypie does, a limit of
+        zero returns everything."""
+
+        limit = int(query.get('limit', [self._default_limit])[0])
+        offset = int(query.get('offset', [0])[0])
+
+        if limit == 0:
+            selected = objects[offset:]
+        else:
+            selected = objects[offset:offset + limit]
+
+        if limit == 0 or offset + limit >= len(objects):
+            next_url = None
+        else:
+            next_url = '?limit={}&offset={}'.format(limit, offset + limit)
+
+        return {'meta': {'limit': limit, 'offset': offset,
+                         'total_count': len(objects), 'next': next_url,
+                         'previous': None},
+                'objects': selected}
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# external libraries
+import slumber
+
+# local libraries
+from fake_localwiki import FakeLocalWiki
+
+
+class TestFakeLocalWiki():
+
+    def setup(self):
+        self.wiki = FakeLocalWiki().start()
+        self.api = slumber.API(self.wiki.api_url, append_slash=False)
+
+    def teardown(self):
+        self.wiki.stop()
+
+    def test_pages_and_files(self):
+
+        try:
+            self.api.page('Front Page').get()
+        except slumber.exceptions.HttpClientError as error:
+            assert error.response.status_code == 404
+        else:
+            assert False, 'The page should not exist yet.'
+
+        self.api.page.post({'name': 'Front Page', 'content': '<p></p>'})
+        assert self.api.page('Front Page').get()['slug'] == 'front page'
+
+        self.api.file.post({'name': 'photo.jpg', 'slug': 'front page'},
+                           files={'file': ('photo.jpg', b'1234')})
+        files = self.api.file.get(slug='front page')['objects']
+        assert [f['name'] for f in files] == ['photo.jpg']
+        assert files[0]['size'] == 4
+
+        self.api.page('Front Page').patch({'content': '<p>Hi</p>'})
+        assert self.api.page('Front Page').get()['content'] == '<p>Hi</p>'
+
+        assert self.wiki.calls[('GET', 'page', 404)] == 1
+        assert self.wiki.calls[('POST', 'file', 201)] == 1
+
+    def test_paging(self):
+
+        self.wiki.add_page('Front Page')
+        for i in range(5):
+            self.wiki.add_file('photo-{}.jpg'.format(i), 'front page')
+
+        response = self.api.file.get(limit=2, offset=2)
+        assert [f['name'] for f in response['objects']] == ['photo-2.jpg',
+                                                            'photo-3.jpg']
+        assert response['meta']['next'] is not None
+
+        response = self.api.file.get(limit=2, offset=4)
+        assert response['meta']['next'] is None
+
+    def test_error_injection(self):
+
+        self.wiki.error_rate = 1.0
+        try:
+            self.api.page('Front Page').get()
+        except slumber.exceptions.HttpServerError as error:
+            assert error.response.status_code == 503
+        else:
+            assert False, 'The request should have failed.'
@@ -0,0 +1,875 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# standard library
+import io
+import os
+import json
+import time
+import shutil
+import tempfile
+import threading
+
+# external libraries
+from gi.repository import GExiv2
+from PIL import Image
+
+# local libraries
+import upload_tagged_photos
+from upload_tagged_photos import (ImageUploader, UploadJournal, RateLimiter,
+                                  RunMetrics, DirectoryWatcher, DecodeBudget,
+                                  MultiWikiUploader, _may_have_keyword,
+                                  default_hash_index_path)
+from fake_localwiki import FakeLocalWiki
+
+
+class TestUploadFakeWiki():
+    """The same fixtures as TestUploadWiki, but on copies of the test
+    images and against a FakeLocalWiki, so no wiki or test.cfg is
+    needed."""
+
+    main_keyword = 'test wiki'
+
+    test_page_names = ['Existing Upload Test Page',
+                       'Non Existing Upload Test Page']
+
+    test_directory_names = ['test-dir-01', 'test-dir-02']
+
+    test_files = [['photo-with-tags-01.jpg',
+                   'photo-with-tags-01.png'],
+                  ['photo-with-tags-02.jpg',
+                   'photo-with-tags-02.png']]
+
+    caption = 'The cool caption.'
+
+    def setup(self):
+
+        self.wiki = FakeLocalWiki().start()
+
+        # copy the directories of images and add the correct keywords to
+        # some of them
+        self.tmp_dir = tempfile.mkdtemp()
+        self.test_directories = []
+        for directory, test_page_name in zip(self.test_directory_names,
+                                             self.test_page_names):
+            copy = os.path.join(self.tmp_dir, directory)
+            shutil.copytree(directory, copy)
+            self.test_directories.append(copy)
+            for file_name in os.listdir(copy):
+                metadata = GExiv2.Metadata(os.path.join(copy, file_name))
+                if '-with-' in file_name:
+                    metadata.set_tag_multiple('Iptc.Application2.Keywords',
+                                              [self.main_keyword, 'page:' +
+                                               test_page_name])
+                metadata['Exif.Image.Orientation'] = '1'
+                metadata['Iptc.Application2.Caption'] = self.caption
+                metadata.save_file()
+
+        # a page that already has the first image on it
+        page = self.wiki.add_page(self.test_page_names[0],
+                                  "<p>The Existing Upload Test Page.</p>")
+        self.wiki.add_file(self.test_files[0][0], page['slug'])
+
+        self.uploader = ImageUploader(self.wiki.api_url, user_name='user',
+                                      api_key='key')
+
+    def teardown(self):
+
+        self.wiki.stop()
+        shutil.rmtree(self.tmp_dir)
+
+    def file_names_on_wiki(self, page_name, wiki=None):
+        """Returns the names of the files on a page of the wiki."""
+
+        if wiki is None:
+            wiki = self.wiki
+        slug = wiki.slugify(page_name)
+        return [f['name'] for f in wiki.files.values() if f['slug'] == slug]
+
+    def assert_uploaded(self, wiki=None):
+        """Checks that each tagged image is on its page."""
+
+        for page_name, test_files in zip(self.test_page_names,
+                                         self.test_files):
+            file_names_on_wiki = self.file_names_on_wiki(page_name, wiki)
+            for file_name in test_files:
+                assert file_name in file_names_on_wiki
+
+    def add_rotated_photo(self, directory, page_name):
+        """Adds a large copy of rotation_test_image.jpg, which has to be
+        resized and rotated before upload, tagged for the page and returns
+        its path."""
+
+        file_path = os.path.join(directory, 'photo-to-rotate.jpg')
+        shutil.copyfile('rotation_test_image.jpg', file_path)
+        metadata = GExiv2.Metadata(file_path)
+        metadata.set_tag_multiple('Iptc.Application2.Keywords',
+                                  [self.main_keyword, 'page:' + page_name])
+        metadata.save_file()
+
+        return file_path
+
+    def uploaded_contents(self, file_name, wiki=None):
+        """Returns the contents of the only file with the name on a wiki
+        that keeps them."""
+
+        if wiki is None:
+            wiki = self.wiki
+        file_ids = [file_id for file_id, f in wiki.files.items() if
+                    f['name'] == file_name]
+        assert len(file_ids) == 1
+        return wiki.contents[file_ids[0]]
+
+    def test_rate_limiter(self):
+        rate_limiter = RateLimiter(10.0, burst=2)
+
+        start = time.time()
+        for i in range(4):
+            rate_limiter.acquire()
+        assert time.time() - start >= 0.15
+
+        rate_limiter.slow_down()
+        assert rate_limiter.rate == 5.0
+        rate_limiter.speed_up()
+        assert rate_limiter.rate == 5.1
+
+    def test_grow_connection_pool(self):
+        old_adapter = self.uploader.session.get_adapter(self.wiki.api_url)
+        closed = []
+        old_adapter.close = lambda: closed.append(old_adapter)
+
+        self.uploader.grow_connection_pool(20)
+
+        adapter = self.uploader.session.get_adapter(self.wiki.api_url)
+        assert adapter is not old_adapter
+        assert adapter._pool_maxsize == 20
+        # The replaced adapter is closed once, it served both schemes.
+        assert closed == [old_adapter]
+        assert self.uploader.page_cache.get(self.test_page_names[0])
+
+    def test_file_index_written_once_per_run(self):
+        cache_path = os.path.join(self.tmp_dir, 'files.json')
+        uploader = ImageUploader(self.wiki.api_url, user_name='user',
+                                 api_key='key', file_index_path=cache_path)
+
+        writes = []
+        write_cache = uploader.file_index._write_cache
+
+        def counting_write_cache(files):
+            writes.append(len(files))
+            write_cache(files)
+
+        uploader.file_index._write_cache = counting_write_cache
+        uploader.upload(self.main_keyword, *self.test_directories)
+
+        # Once with the listing fetched, and once at the end of the run.
+        assert writes == [1, len(sum(self.test_files, []))]
+
+        with open(cache_path) as f:
+            cached_files = json.load(f)['files']
+        assert sorted((f['name'], f['slug']) for f in cached_files) == \
+            sorted((f['name'], f['slug']) for f in self.wiki.files.values())
+
+    def test_file_index_stops_at_empty_page(self):
+        listing = self.wiki._listing
+
+        def listing_without_end(objects, query):
+            response = listing(objects, query)
+            response['meta']['next'] = '?offset=1000'
+            return response
+
+        self.wiki._listing = listing_without_end
+        self.uploader.file_index._page_size = 1
+
+        assert self.uploader.file_index.exists(self.test_files[0][0])
+        assert self.wiki.calls[('GET', 'file', 200)] == 2
+
+    def test_metrics(self):
+        self.uploader.metrics.reset()
+        self.uploader.upload(self.main_keyword, *self.test_directories)
+
+        stages = self.uploader.metrics.summary()['stages']
+        for stage in ['scan', 'create_page', 'upload_image', 'embed_images',
+                      'upload']:
+            assert stages[stage]['calls'] > 0
+        # The metadata is read while scanning, not again for the upload.
+        assert 'read_metadata' not in stages
+        # setup() already put the first photo on the existing page.
+        assert stages['upload_image']['calls'] == 3
+
+        calls = self.uploader.metrics.api_calls
+        assert calls[('POST', 'file', 201)] == 3
+        assert calls == self.wiki.calls
+        assert self.uploader.metrics.bytes_sent['file'] > 0
+
+    def test_metrics_to_prometheus(self):
+        metrics = RunMetrics()
+        with metrics.stage('resize'):
+            time.sleep(0.01)
+        metrics.record_call('GET', 'page', 404)
+        text = metrics.to_prometheus()
+        assert 'localwiki_upload_stage_calls_total{stage="resize"} 1' in text
+        assert ('localwiki_upload_api_calls_total{method="GET",'
+                'endpoint="page",status="404"} 1') in text
+
+    def test_find_localwiki_images_recursively(self):
+        nested_directory = os.path.join(self.test_directories[0], 'nested')
+        os.mkdir(nested_directory)
+        nested_path = os.path.join(nested_directory, self.test_files[0][0])
+        shutil.copyfile(os.path.join(self.test_directories[0],
+                                     self.test_files[0][0]), nested_path)
+
+        self.uploader.directories = self.test_directories[:1]
+        self.uploader.main_keyword = self.main_keyword
+
+        assert nested_path not in self.uploader.find_localwiki_images()
+
+        self.uploader.recursive = True
+        wiki_images = self.uploader.find_localwiki_images()
+        assert nested_path in wiki_images
+
+        self.uploader.exclude_patterns = ['nested']
+        self.uploader.include_patterns = ['*.jpg']
+        wiki_images = self.uploader.find_localwiki_images()
+        assert nested_path not in wiki_images
+        assert sorted(wiki_images.keys()) == [os.path.join(
+            self.test_directories[0], self.test_files[0][0])]
+
+    def test_find_image_files_skips_unreadable_directories(self):
+        for name in ['a', 'b']:
+            nested_directory = os.path.join(self.test_directories[0], name)
+            os.mkdir(nested_directory)
+            shutil.copyfile(os.path.join(self.test_directories[0],
+                                         self.test_files[0][0]),
+                            os.path.join(nested_directory,
+                                         self.test_files[0][0]))
+        unreadable = os.path.join(self.test_directories[0], 'a')
+
+        scandir = upload_tagged_photos.scandir
+
+        def failing_scandir(path):
+            if path == unreadable:
+                raise OSError(13, 'Permission denied', path)
+            return scandir(path)
+
+        self.uploader.recursive = True
+        upload_tagged_photos.scandir = failing_scandir
+        try:
+            file_paths = list(self.uploader.find_image_files(
+                self.test_directories[0]))
+        finally:
+            upload_tagged_photos.scandir = scandir
+
+        assert os.path.join(self.test_directories[0], 'b',
+                            self.test_files[0][0]) in file_paths
+        assert not any(path.startswith(unreadable) for path in file_paths)
+        assert len(file_paths) == 5
+
+    def test_watch_for_changes(self):
+        directory = self.test_directories[0]
+        self.uploader.directories = [directory]
+        self.uploader.recursive = False
+
+        photo_path = os.path.join(directory, self.test_files[0][0])
+        assert self.uploader.is_watched_file(photo_path)
+        assert not self.uploader.is_watched_file(os.path.join(
+            directory, self.uploader._tmp_dir_name, self.test_files[0][0]))
+        assert not self.uploader.is_watched_file(os.path.join(
+            directory, 'notes.txt'))
+
+        watcher = DirectoryWatcher([directory],
+                                   self.uploader.find_image_files,
+                                   self.uploader.is_watched_file,
+                                   debounce=0.1, poll_interval=0.1,
+                                   use_inotify=False)
+        changes = watcher.changes()
+
+        copy_path = os.path.join(directory, 'copy-' + self.test_files[0][0])
+        shutil.copyfile(photo_path, copy_path)
+        changed, removed = next(changes)
+        assert changed == set([copy_path])
+        assert removed == set()
+
+        os.remove(copy_path)
+        changed, removed = next(changes)
+        assert changed == set()
+        assert removed == set([copy_path])
+
+        changes.close()
+
+    def test_find_localwiki_images_in_parallel(self):
+        self.uploader.directories = self.test_directories
+        self.uploader.main_keyword = self.main_keyword
+        serial_wiki_images = self.uploader.find_localwiki_images()
+
+        self.uploader.scan_workers = 4
+        parallel_wiki_images = self.uploader.find_localwiki_images()
+
+        assert parallel_wiki_images == serial_wiki_images
+
+    def test_scan_index(self):
+        index_path = os.path.join(self.tmp_dir, 'scan-index.db')
+        uploader = ImageUploader(self.wiki.api_url, user_name='user',
+                                 api_key='key', scan_index_path=index_path)
+        uploader.directories = self.test_directories
+        uploader.main_keyword = self.main_keyword
+
+        first_wiki_images = uploader.find_localwiki_images()
+
+        file_paths = list(first_wiki_images.keys())
+        known, unknown = uploader.scan_index.partition(file_paths)
+        assert sorted(known.keys()) == sorted(file_paths)
+        assert unknown == {}
+
+        assert uploader.find_localwiki_images() == first_wiki_images
+
+        uploader.scan_index.close()
+
+    def test_scan_index_keeps_untagged_files(self):
+        uploader = ImageUploader(
+            self.wiki.api_url, user_name='user', api_key='key',
+            scan_index_path=os.path.join(self.tmp_dir, 'scan-index.db'))
+        uploader.directories = self.test_directories
+        uploader.main_keyword = self.main_keyword
+
+        checked = []
+        may_have_keyword = upload_tagged_photos._may_have_keyword
+
+        def counting_may_have_keyword(file_path, keyword):
+            checked.append(file_path)
+            return may_have_keyword(file_path, keyword)
+
+        upload_tagged_photos._may_have_keyword = counting_may_have_keyword
+        try:
+            wiki_images = uploader.find_localwiki_images()
+            untagged_paths = [path for path in checked if path not in
+                              wiki_images]
+            assert len(untagged_paths) == len(self.test_directories) * 2
+
+            # Nothing is opened again for the same keyword.
+            del checked[:]
+            assert uploader.find_localwiki_images() == wiki_images
+            assert checked == []
+
+            # The untagged files are checked again for another keyword.
+            uploader.main_keyword = 'another wiki'
+            assert uploader.find_localwiki_images() == {}
+            assert sorted(checked) == sorted(untagged_paths)
+        finally:
+            upload_tagged_photos._may_have_keyword = may_have_keyword
+
+        uploader.scan_index.close()
+
+    def test_image_records(self):
+        self.uploader.directories = self.test_directories
+        self.uploader.main_keyword = self.main_keyword
+        wiki_images = self.uploader.find_localwiki_images()
+
+        for file_path, (page_names, template) in wiki_images.items():
+            record = self.uploader.image_records[file_path]
+            metadata = GExiv2.Metadata(file_path)
+            assert record.page_names == page_names
+            assert record.template == template
+            assert self.main_keyword in record.keywords
+            assert record.orientation == '1'
+            assert record.width == metadata.get_pixel_width()
+            assert record.height == metadata.get_pixel_height()
+            assert record.caption == self.caption
+
+        # The record is used instead of reading the metadata again.
+        file_path = sorted(wiki_images.keys())[0]
+        record = self.uploader.image_records[file_path]._replace(
+            caption='From the record')
+        caption = self.uploader.prepare_image(file_path, record=record)[2]
+        assert caption == 'From the record'
+
+    def test_keyword_prefilter(self):
+        for directory in self.test_directories:
+            for file_name in os.listdir(directory):
+                file_path = os.path.join(directory, file_name)
+                if '-with-' in file_name:
+                    assert _may_have_keyword(file_path, self.main_keyword)
+                    assert not _may_have_keyword(file_path,
+                                                 'not a keyword in here')
+                elif '-without-' in file_name:
+                    assert not _may_have_keyword(file_path,
+                                                 self.main_keyword)
+
+    def test_upload_journal(self):
+        journal = UploadJournal(os.path.join(self.tmp_dir, 'journal.db'))
+
+        file_path = os.path.join(self.test_directories[0],
+                                 self.test_files[0][0])
+        page_name = self.test_page_names[0]
+
+        assert journal.step(file_path, page_name) == \
+            (UploadJournal.NOT_STARTED, None)
+
+        journal.record(file_path, page_name, UploadJournal.UPLOADED,
+                       'existing upload test page')
+        assert journal.step(os.path.abspath(file_path), page_name) == \
+            (UploadJournal.UPLOADED, 'existing upload test page')
+
+        journal.clear()
+        assert journal.step(file_path, page_name)[0] == \
+            UploadJournal.NOT_STARTED
+
+        journal.close()
+
+    def test_deduplicate(self):
+        file_path = os.path.join(self.test_directories[0],
+                                 self.test_files[0][0])
+        copy_path = os.path.join(self.test_directories[1],
+                                 self.test_files[0][0])
+        other_path = os.path.join(self.test_directories[1],
+                                  self.test_files[1][0])
+        shutil.copyfile(file_path, copy_path)
+        page_name = self.test_page_names[0]
+
+        wiki_images = self.uploader.deduplicate({
+            file_path: ([page_name], None),
+            copy_path: ([page_name], None),
+            other_path: ([page_name], None)})
+
+        assert sorted(wiki_images.keys()) == sorted([file_path, other_path])
+
+        content_hash, name = self.uploader.upload_names[file_path]
+        self.uploader.hash_index.record(content_hash, page_name, name)
+
+        assert self.uploader.upload_names[other_path][1] == \
+            'photo-with-tags-02.jpg'
+        assert self.uploader.upload_name(file_path, 'abcdef0123') == \
+            'photo-with-tags-01-abcdef01.jpg'
+
+    def test_hashes_kept_in_scan_index(self):
+        uploader = ImageUploader(
+            self.wiki.api_url, user_name='user', api_key='key',
+            scan_index_path=os.path.join(self.tmp_dir, 'scan-index.db'))
+        uploader.directories = self.test_directories
+        uploader.main_keyword = self.main_keyword
+        wiki_images = uploader.find_localwiki_images()
+
+        hashed = []
+        file_hash = upload_tagged_photos._file_hash
+
+        def counting_file_hash(file_path):
+            hashed.append(file_path)
+            return file_hash(file_path)
+
+        upload_tagged_photos._file_hash = counting_file_hash
+        try:
+            uploader.deduplicate(wiki_images)
+            first_upload_names = uploader.upload_names
+            assert sorted(hashed) == sorted(wiki_images.keys())
+
+            # Only the changed file is read again.
+            del hashed[:]
+            file_path = sorted(wiki_images.keys())[0]
+            with open(file_path, 'ab') as f:
+                f.write(b'\0')
+            uploader.find_localwiki_images()
+            uploader.deduplicate(wiki_images)
+            assert hashed == [file_path]
+        finally:
+            upload_tagged_photos._file_hash = file_hash
+
+        for other_path in sorted(wiki_images.keys())[1:]:
+            assert uploader.upload_names[other_path] == \
+                first_upload_names[other_path]
+        assert uploader.upload_names[file_path][0] == file_hash(file_path)
+
+        uploader.scan_index.close()
+
+    def test_same_name_in_later_run(self):
+        hash_index_path = os.path.join(self.tmp_dir, 'hashes.db')
+        file_name = self.test_files[1][0]
+        directory = self.test_directories[1]
+
+        uploader = ImageUploader(self.wiki.api_url, user_name='user',
+                                 api_key='key',
+                                 hash_index_path=hash_index_path)
+        uploader.upload(self.main_keyword, directory)
+        uploader.hash_index.close()
+
+        # A different photo with the same name, tagged for the same page.
+        other_directory = os.path.join(self.tmp_dir, 'other')
+        os.mkdir(other_directory)
+        other_path = os.path.join(other_directory, file_name)
+        shutil.copyfile('rotation_test_image.jpg', other_path)
+        metadata = GExiv2.Metadata(other_path)
+        metadata.set_tag_multiple('Iptc.Application2.Keywords',
+                                  [self.main_keyword, 'page:' +
+                                   self.test_page_names[1]])
+        metadata.save_file()
+
+        uploader = ImageUploader(self.wiki.api_url, user_name='user',
+                                 api_key='key',
+                                 hash_index_path=hash_index_path)
+        uploader.upload(self.main_keyword, directory, other_directory)
+        uploader.hash_index.close()
+
+        file_names_on_wiki = self.file_names_on_wiki(self.test_page_names[1])
+        assert len(file_names_on_wiki) == 3
+        assert file_names_on_wiki.count(file_name) == 1
+        assert uploader.upload_names[other_path][1] != file_name
+
+    def test_hashes_only_recorded_for_own_uploads(self):
+        self.uploader.upload(self.main_keyword, *self.test_directories)
+
+        slug = self.wiki.slugify(self.test_page_names[0])
+        hash_index = self.uploader.hash_index
+        own_path, other_path = [os.path.join(self.test_directories[0],
+                                             file_name) for file_name in
+                                reversed(self.test_files[0])]
+
+        # setup() put a file of the same name there, it may be another
+        # photo, so it is embedded but its hash isn't recorded.
+        page = self.wiki.pages[slug]
+        assert '_files/' + self.test_files[0][0] in page['content']
+        assert not hash_index.was_posted(slug, self.test_files[0][0])
+        assert hash_index.lookup(upload_tagged_photos._file_hash(other_path),
+                                 self.test_page_names[0]) is None
+
+        assert hash_index.was_posted(slug, self.test_files[0][1])
+        assert hash_index.lookup(upload_tagged_photos._file_hash(own_path),
+                                 self.test_page_names[0]) == \
+            self.test_files[0][1]
+
+        # Only the page the uploader posted is listed as created by it.
+        created = [row[0] for row in hash_index.connection.execute(
+            "SELECT slug FROM created")]
+        assert created == [self.wiki.slugify(self.test_page_names[1])]
+
+    def test_default_hash_index_path(self):
+        path = default_hash_index_path('http://clevelandwiki.org:8000/api/')
+        assert os.path.dirname(path) == os.path.expanduser('~')
+        assert os.path.basename(path) == \
+            '.localwiki-hashes-clevelandwiki.org-8000.db'
+
+    def test_resume_after_failed_embed(self):
+
+        def fail_to_embed(page_name, images):
+            raise IOError('The connection dropped.')
+
+        for journal_path in [os.path.join(self.tmp_dir, 'journal.db'), None]:
+            self.wiki.reset()
+            self.wiki.add_page(self.test_page_names[0])
+            hash_index_path = os.path.join(self.tmp_dir, 'hashes.db')
+            if os.path.exists(hash_index_path):
+                os.remove(hash_index_path)
+
+            uploader = ImageUploader(self.wiki.api_url, user_name='user',
+                                     api_key='key',
+                                     journal_path=journal_path,
+                                     hash_index_path=hash_index_path)
+            uploader.embed_images = fail_to_embed
+            try:
+                uploader.upload(self.main_keyword, *self.test_directories)
+            except IOError:
+                pass
+            else:
+                assert False, 'The embed should have failed.'
+            uploader.hash_index.close()
+            if journal_path is not None:
+                uploader.journal.close()
+
+            uploader = ImageUploader(self.wiki.api_url, user_name='user',
+                                     api_key='key',
+                                     journal_path=journal_path,
+                                     hash_index_path=hash_index_path)
+            uploader.upload(self.main_keyword, *self.test_directories)
+            uploader.hash_index.close()
+            if journal_path is not None:
+                uploader.journal.close()
+
+            self.assert_uploaded()
+            for page_name, test_files in zip(self.test_page_names,
+                                             self.test_files):
+                assert len(self.file_names_on_wiki(page_name)) == \
+                    len(test_files)
+                content = self.wiki.pages[self.wiki.slugify(page_name)][
+                    'content']
+                for file_name in test_files:
+                    assert content.count('_files/' + file_name) == 1
+
+    def test_page_cache(self):
+
+        page_name = self.test_page_names[0]
+
+        page_info = self.uploader.page_cache.get(page_name)
+        assert self.uploader.page_cache.get(page_name) is page_info
+        assert self.uploader.page_cache.by_slug[page_info['slug']] is \
+            page_info
+
+        fresh_page_info = self.uploader.page_cache.get(page_name, fresh=True)
+        assert fresh_page_info is not page_info
+        assert self.uploader.page_cache.get(page_name) is fresh_page_info
+
+    def test_normalize_image(self):
+
+        tmp_image_path = os.path.join(self.tmp_dir,
+                                      'normalize_test_image.jpg')
+
+        metadata_before = GExiv2.Metadata('rotation_test_image.jpg')
+
+        width, height = self.uploader.normalize_image(
+            'rotation_test_image.jpg', tmp_image_path)
+
+        metadata_after = GExiv2.Metadata(tmp_image_path)
+
+        assert metadata_after['Exif.Image.Orientation'] == '1'
+        assert metadata_after.get_pixel_width() == width
+        assert metadata_after.get_pixel_height() == height
+        assert min(metadata_before.get_pixel_width(), 1024) == height
+
+        for tag in metadata_before.get_iptc_tags():
+            assert metadata_after[tag] == metadata_before[tag]
+
+    def test_encode_image_with_decode_budget(self):
+
+        # The image is bigger than the whole budget, so it is decoded on
+        # its own.
+        data, size = self.uploader.encode_image('resize_test_image.jpg',
+                                                decode_budget=DecodeBudget(1))
+
+        assert data is not None
+        assert size[0] <= 1024
+
+        budget = DecodeBudget(4)
+        reserved = threading.Event()
+
+        def reserve_two_megabytes():
+            with budget.reserve(2 * 2 ** 20):
+                reserved.set()
+
+        with budget.reserve(3 * 2 ** 20):
+            # The rest of the budget can still be used.
+            with budget.reserve(2 ** 20):
+                pass
+            thread = threading.Thread(target=reserve_two_megabytes)
+            thread.start()
+            # But not more than that until the first image is done.
+            assert not reserved.wait(0.2)
+
+        assert reserved.wait(5.0)
+        thread.join()
+
+    def test_encode_images(self):
+
+        images = self.uploader.encode_images('resize_test_image.jpg',
+                                             widths=[300, 100000])
+
+        main_data, main_size = images[0]
+        data, size = images[1]
+        assert main_size[0] <= 1024
+        assert size[0] == 300
+        assert abs(float(size[0]) / size[1] -
+                   float(main_size[0]) / main_size[1]) < 0.01
+        # No derivative is made larger than the original.
+        assert images[2] is None
+
+    def test_image_html_with_variants(self):
+        html = self.uploader.image_html(
+            'photo.jpg', 4.0 / 3.0, self.caption,
+            [('photo-2048w.jpg', 2048), ('photo.jpg', 1024),
+             ('photo-300w.jpg', 300)])
+
+        assert '<img src="_files/photo-300w.jpg" srcset="' \
+            '_files/photo-300w.jpg 300w, _files/photo.jpg 1024w, ' \
+            '_files/photo-2048w.jpg 2048w" sizes="300px"' in html
+
+    def test_needs_processing(self):
+
+        assert self.uploader.needs_processing(
+            GExiv2.Metadata('rotation_test_image.jpg'))
+        assert self.uploader.needs_processing(
+            GExiv2.Metadata('resize_test_image.jpg'))
+        assert not self.uploader.needs_processing(GExiv2.Metadata(
+            os.path.join(self.test_directories[0], self.test_files[0][0])))
+
+    def test_embed_images(self):
+        page_info = self.uploader.embed_images(
+            self.test_page_names[0],
+            [('photo-with-tags-01.jpg', 3.0 / 4.0, self.caption),
+             ('booger.png', 1.0, self.caption)])
+
+        assert self.uploader.image_html('photo-with-tags-01.jpg', 3.0 / 4.0,
+                                        self.caption) in page_info['content']
+        assert 'booger.png' not in page_info['content']
+
+        page_info = self.uploader.embed_images(
+            self.test_page_names[0],
+            [('photo-with-tags-01.jpg', 3.0 / 4.0, self.caption)])
+        assert page_info is None
+
+    def test_parse_keywords_with_prefix(self):
+        page_names, template = ImageUploader.parse_keywords(
+            ['page:Front Page', 'east:Harbor: Docks', 'template:Business'],
+            'east:')
+        assert page_names == ['Harbor: Docks']
+        assert template == 'Business'
+
+    def test_upload(self):
+        self.uploader.upload(self.main_keyword, *self.test_directories)
+
+        self.assert_uploaded()
+
+        # The image that was already on the page isn't uploaded again.
+        assert self.file_names_on_wiki(self.test_page_names[0]).count(
+            self.test_files[0][0]) == 1
+
+        for page_name in self.test_page_names:
+            page = self.wiki.pages[self.wiki.slugify(page_name)]
+            assert self.caption in page['content']
+
+    def test_plan(self):
+        plan = self.uploader.plan(self.main_keyword, *self.test_directories)
+
+        assert plan['pages'][self.test_page_names[0]]['exists']
+        assert not plan['pages'][self.test_page_names[1]]['exists']
+        assert sorted(image['name'] for image in plan['images']) == \
+            sorted(sum(self.test_files, []))
+        # setup() already put the first photo on the existing page.
+        for image in plan['images']:
+            if image['name'] == self.test_files[0][0]:
+                assert image['action'] == 'skip'
+                assert image['reason'] == 'exists'
+            else:
+                assert image['action'] == 'upload'
+                assert image['reason'] is None
+
+        # Nothing is changed on the server until the plan is executed.
+        assert len(self.wiki.files) == 1
+        assert len(self.wiki.pages) == 1
+
+        self.uploader.execute_plan(plan)
+
+        self.assert_uploaded()
+        assert len(self.wiki.files) == len(sum(self.test_files, []))
+
+    def test_plan_page_name_in_other_case(self):
+        file_path = os.path.join(self.test_directories[0],
+                                 'photo-without-tags-01.jpg')
+        page_name = self.test_page_names[0].lower()
+        metadata = GExiv2.Metadata(file_path)
+        metadata.set_tag_multiple('Iptc.Application2.Keywords',
+                                  [self.main_keyword, 'page:' + page_name])
+        metadata.save_file()
+
+        plan = self.uploader.plan(self.main_keyword, *self.test_directories)
+
+        assert plan['pages'][page_name]['exists']
+        assert plan['pages'][page_name]['template'] is None
+
+        self.uploader.execute_plan(plan)
+
+        # The photo went on the existing page instead of a new one.
+        assert len(self.wiki.pages) == 2
+        assert 'photo-without-tags-01.jpg' in self.file_names_on_wiki(
+            self.test_page_names[0])
+
+    def test_page_template(self):
+        self.wiki.add_page('Templates/Business', '<p>A business.</p>')
+        page_name = 'Template Test Page'
+        # The first photo for the page, by path, has no template.
+        self.add_rotated_photo(self.test_directories[0], page_name)
+        file_path = os.path.join(self.test_directories[1],
+                                 'photo-without-tags-02.jpg')
+        metadata = GExiv2.Metadata(file_path)
+        metadata.set_tag_multiple('Iptc.Application2.Keywords',
+                                  [self.main_keyword, 'page:' + page_name,
+                                   'template:Business'])
+        metadata.save_file()
+
+        plan = self.uploader.plan(self.main_keyword, *self.test_directories)
+        assert plan['pages'][page_name]['template'] == 'Business'
+        assert plan['pages'][page_name]['template_exists']
+
+        self.uploader.upload(self.main_keyword, *self.test_directories)
+
+        page = self.wiki.pages[self.wiki.slugify(page_name)]
+        assert '<p>A business.</p>' in page['content']
+
+    def test_upload_derivatives(self):
+        self.uploader.upload(self.main_keyword, *self.test_directories,
+                             derivative_widths=[5])
+
+        self.assert_uploaded()
+
+        for page_name, test_files in zip(self.test_page_names,
+                                         self.test_files):
+            file_names_on_wiki = self.file_names_on_wiki(page_name)
+            for file_name in test_files:
+                # The test photos are 10 pixels wide.
+                derivative_name = self.uploader.derivative_name(file_name, 5)
+                if file_name == self.test_files[0][0]:
+                    # setup() already put this photo on the page, so it is
+                    # skipped along with its copies.
+                    assert derivative_name not in file_names_on_wiki
+                else:
+                    assert derivative_name in file_names_on_wiki
+            page = self.wiki.pages[self.wiki.slugify(page_name)]
+            assert 'srcset' in page['content']
+
+    def test_upload_pipelined(self):
+        self.uploader.upload(self.main_keyword, *self.test_directories,
+                             processes=2, concurrency=2)
+
+        self.assert_uploaded()
+
+    def test_upload_in_memory(self):
+        self.wiki.keep_contents = True
+        rotated_path = self.add_rotated_photo(self.test_directories[1],
+                                              self.test_page_names[1])
+
+        self.uploader.upload(self.main_keyword, *self.test_directories,
+                             in_memory=True)
+
+        for directory in self.test_directories:
+            assert not os.path.isdir(os.path.join(
+                directory, self.uploader._tmp_dir_name))
+
+        self.assert_uploaded()
+
+        # The processed image is uploaded from memory.
+        contents = self.uploaded_contents('photo-to-rotate.jpg')
+        assert contents == self.uploader.encode_image(rotated_path)[0]
+        assert Image.open(io.BytesIO(contents)).size == (768, 1024)
+
+        # The images that need no processing are uploaded as they are.
+        file_path = os.path.join(self.test_directories[1],
+                                 self.test_files[1][0])
+        with open(file_path, 'rb') as f:
+            assert self.uploaded_contents(self.test_files[1][0]) == f.read()
+
+    def test_upload_to_several_wikis(self):
+        self.add_rotated_photo(self.test_directories[1],
+                               self.test_page_names[1])
+        with FakeLocalWiki() as mirror:
+            uploader = MultiWikiUploader([
+                {'name': 'main', 'api_url': self.wiki.api_url,
+                 'user_name': 'user', 'api_key': 'key'},
+                {'name': 'mirror', 'api_url': mirror.api_url,
+                 'user_name': 'mirror', 'api_key': 'mirror',
+                 'concurrency': 2}])
+            # The second page's images are split over two batches.
+            uploader.upload(self.main_keyword, *self.test_directories,
+                            processes=2, batch_size=2)
+
+            # The images are prepared once for both wikis, only the
+            # rotated photo needs processing.
+            assert uploader.metrics.stages['process_image'][0] == 1
+
+            self.assert_uploaded()
+            self.assert_uploaded(mirror)
+
+            num_images = len(sum(self.test_files, [])) + 1
+            for status in uploader.status.values():
+                assert status['done'] == num_images
+                assert status['error'] is None
+
+            # Each page is patched once, after its last batch.
+            for wiki in (self.wiki, mirror):
+                assert wiki.calls[('PATCH', 'page', 202)] == 2
+                assert 'photo-to-rotate.jpg' in self.file_names_on_wiki(
+                    self.test_page_names[1], wiki)
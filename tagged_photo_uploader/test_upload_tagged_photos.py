@@ -117,6 +117,7 @@ class TestUploadWiki():
 
         assert self.uploader.api._store['base_url'] == self.api_url
         assert self.uploader.api._store['format'] == 'json'
+        assert self.uploader.api._store['session'] is self.uploader.session
 
     def test_remove_tmp_dirs(self):
         directories = ['localwikidir1', 'localwikidir2']
@@ -215,6 +216,10 @@ class TestUploadWiki():
 
         assert not self.uploader.file_exists_on_server('booglediddly.png')
         assert self.uploader.file_exists_on_server('photo-with-tags-01.jpg')
+        assert self.uploader.file_exists_on_server('photo-with-tags-01.jpg',
+            slug='existing upload test page')
+        assert not self.uploader.file_exists_on_server(
+            'photo-with-tags-01.jpg', slug='non existing upload test page')
 
     def test_rotate_image(self):
 
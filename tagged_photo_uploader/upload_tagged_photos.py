@@ -2,120 +2,2883 @@
 # -*- coding: utf-8 -*-
 
 # standard library
+import io
 import os
+import math
+import zlib
+import struct
+import binascii
+import fnmatch
+import hashlib
+import itertools
+import time
+import random
+import json
 import shutil
+import contextlib
+import sqlite3
 import getpass
+import threading
+import collections
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+try:
+    from os import scandir
+except ImportError:  # Python 2 needs the scandir backport
+    from scandir import scandir
+try:
+    from urllib.parse import urlparse
+except ImportError:  # Python 2
+    from urlparse import urlparse
+try:
+    import pyinotify
+except ImportError:  # Watching falls back to polling
+    pyinotify = None
 
 # external libraries
+import requests
 import slumber
 from gi.repository import GExiv2
 from PIL import Image
 
 
+def _initialize_exiv2():
+    """Sets up Exiv2 before any metadata is read. Its XMP parser can't be
+    initialized safely from several threads at once, so this has to be
+    done before the scan threads start. GExiv2 before 0.10 has no
+    initialize and sets itself up on first use."""
+    if hasattr(GExiv2, 'initialize'):
+        GExiv2.initialize()
+
+
+_initialize_exiv2()
+
+
+class ServerFileIndex(object):
+    """A local index of the files stored on the server, keyed by file name
+    and by the slug of the page each file is attached to. The file listing
+    is fetched from the API once, in pages, and then kept up to date
+    locally as files are uploaded. The files added are written to the
+    cache file by save, once per run."""
+
+    _page_size = 500
+
+    def __init__(self, api, cache_path=None, max_age=3600.0):
+        """Initializes the index, the listing is not fetched until it is
+        first needed.
+
+        Parameters
+        ==========
+        api : slumber.API
+            The API the files are fetched from.
+        cache_path : string, optional, default=None
+            If provided the index is saved to and loaded from this JSON
+            file, so that subsequent runs don't have to fetch the listing.
+        max_age : float, optional, default=3600.0
+            The number of seconds after which a cached index is considered
+            stale and is fetched again from the server.
+
+        """
+        self.api = api
+        self.cache_path = cache_path
+        self.max_age = max_age
+        self.by_name = None
+        self.by_slug = None
+        self.fetched = None
+        self._dirty = False
+        self._lock = threading.Lock()
+
+    def load(self):
+        """Populates the index from the cache file if it is fresh,
+        otherwise from the server."""
+
+        self.by_name = {}
+        self.by_slug = {}
+
+        files = self._read_cache()
+        if files is None:
+            files = self._fetch()
+            self.fetched = time.time()
+            self._write_cache(files)
+
+        for file_dict in files:
+            self._insert(file_dict)
+
+    def _read_cache(self):
+        """Returns the list of cached file dictionaries or None if there is
+        no usable cache."""
+
+        if self.cache_path is None or not os.path.isfile(self.cache_path):
+            return None
+
+        with open(self.cache_path, 'r') as f:
+            try:
+                cache = json.load(f)
+            except ValueError:
+                return None
+
+        if (cache.get('api_url') != self.api._store['base_url'] or
+                time.time() - cache.get('fetched', 0.0) > self.max_age):
+            return None
+
+        self.fetched = cache['fetched']
+
+        return cache['files']
+
+    def _write_cache(self, files):
+        """Saves the list of file dictionaries to the cache file."""
+
+        if self.cache_path is None:
+            return
+
+        # The listing is as old as its fetch from the server, the files
+        # added since don't make it any fresher.
+        cache = {'api_url': self.api._store['base_url'],
+                 'fetched': self.fetched,
+                 'files': files}
+
+        with open(self.cache_path, 'w') as f:
+            json.dump(cache, f)
+
+    def _fetch(self):
+        """Returns a list of dictionaries with the name and page slug of
+        every file on the server, fetched a page of results at a time."""
+
+        files = []
+        offset = 0
+        while True:
+            response = self.api.file.get(limit=self._page_size,
+                                         offset=offset)
+            files.extend([{'name': f['name'], 'slug': f['slug']} for f in
+                          response['objects']])
+            # An empty page would otherwise be asked for forever.
+            if response['meta']['next'] is None or not response['objects']:
+                break
+            offset += len(response['objects'])
+
+        return files
+
+    def _insert(self, file_dict):
+        self.by_name.setdefault(file_dict['name'], set()).add(
+            file_dict['slug'])
+        self.by_slug.setdefault(file_dict['slug'], set()).add(
+            file_dict['name'])
+
+    def add(self, file_name, slug):
+        """Records a file that was just uploaded to the page with the given
+        slug, see save for updating the cache file.
+
+        Parameters
+        ==========
+        file_name : string
+            The name of the file, as stored in localwiki.
+        slug : string
+            The slug of the page the file is attached to.
+
+        """
+        if self.by_name is None:
+            self.load()
+
+        with self._lock:
+            self._insert({'name': file_name, 'slug': slug})
+            self._dirty = True
+
+    def save(self):
+        """Writes the files added since the listing was loaded to the
+        cache file, if there is one."""
+
+        with self._lock:
+            if not self._dirty or self.cache_path is None:
+                return
+
+            self._write_cache([{'name': name, 'slug': s} for name, slugs
+                               in self.by_name.items() for s in slugs])
+            self._dirty = False
+
+    def exists(self, file_name, slug=None):
+        """Returns true if a file with this name is on the server. If a
+        slug is given, the file must also be attached to that page.
+
+        Parameters
+        ==========
+        file_name : string
+            The name of the file, as stored in localwiki.
+        slug : string, optional, default=None
+            The slug of a page.
+
+        """
+        if self.by_name is None:
+            self.load()
+
+        if slug is None:
+            return file_name in self.by_name
+        else:
+            return file_name in self.by_slug.get(slug, set())
+
+
+def _is_not_found(error):
+    """Returns true if the slumber error is a 404."""
+    response = getattr(error, 'response', None)
+    return response is not None and response.status_code == 404
+
+
+def _slugify(page_name):
+    """Returns the slug LocalWiki gives a page name, which is how it looks
+    pages up: lower case, with runs of spaces and underscores made a
+    single space."""
+    return ' '.join(page_name.replace('_', ' ').split()).lower()
+
+
+class RateLimiter(object):
+    """A token bucket that limits the rate of requests, shared by all the
+    threads making them. The rate adapts to the server: it is halved when
+    the server throttles a request and creeps back up to the configured
+    rate as requests succeed."""
+
+    def __init__(self, rate, burst=None):
+        """Initializes a full bucket.
+
+        Parameters
+        ==========
+        rate : float
+            The maximum number of requests per second.
+        burst : integer, optional, default=None
+            The number of requests that can be made at once after a quiet
+            period, the rate rounded up if None.
+
+        """
+        self.max_rate = float(rate)
+        self.rate = float(rate)
+        self.burst = burst if burst is not None else max(1, int(rate + 0.5))
+        self._tokens = float(self.burst)
+        self._last = time.time()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Blocks until a request can be made."""
+
+        while True:
+            with self._lock:
+                now = time.time()
+                self._tokens = min(self.burst, self._tokens +
+                                   (now - self._last) * self.rate)
+                self._last = now
+                if self._tokens >= 1.0:
+                    self._tokens -= 1.0
+                    return
+                wait = (1.0 - self._tokens) / self.rate
+            time.sleep(wait)
+
+    def slow_down(self):
+        """Halves the rate, after the server throttled a request."""
+        with self._lock:
+            self.rate = max(self.rate / 2.0, self.max_rate / 64.0)
+
+    def speed_up(self):
+        """Raises the rate a little, after a request succeeded."""
+        with self._lock:
+            self.rate = min(self.rate + self.max_rate / 100.0, self.max_rate)
+
+
+class RunMetrics(object):
+    """Records how long each stage of a run takes and the API calls made,
+    by endpoint and status, along with the bytes sent. It is shared by all
+    the threads of a run; override record_stage and record_call to hook
+    into the measurements as they are made."""
+
+    _prometheus_prefix = 'localwiki_upload'
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Clears all the measurements."""
+
+        with self._lock:
+            # stage name -> [number of calls, total seconds, max seconds]
+            self.stages = {}
+            self.api_calls = collections.Counter()
+            self.bytes_sent = collections.Counter()
+            self.retries = 0
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """A context manager that records the time spent in its block under
+        the stage name, e.g.::
+
+            with metrics.stage('upload_image'):
+                ...
+
+        """
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.record_stage(name, time.time() - start)
+
+    def record_stage(self, name, duration, count=1, longest=None):
+        """Adds a duration in seconds to the stage's totals."""
+
+        if longest is None:
+            longest = duration
+
+        with self._lock:
+            totals = self.stages.setdefault(name, [0, 0.0, 0.0])
+            totals[0] += count
+            totals[1] += duration
+            totals[2] = max(totals[2], longest)
+
+    def merge_stages(self, stages):
+        """Adds the stage totals of another RunMetrics, e.g. one filled in
+        a worker process."""
+
+        for name, (count, duration, longest) in stages.items():
+            self.record_stage(name, duration, count, longest)
+
+    def record_call(self, method, endpoint, status, bytes_sent=0):
+        """Counts an API call and the size of its request body."""
+
+        with self._lock:
+            self.api_calls[(method, endpoint, status)] += 1
+            self.bytes_sent[endpoint] += bytes_sent
+
+    def record_retry(self):
+        """Counts a request that is about to be retried."""
+
+        with self._lock:
+            self.retries += 1
+
+    def summary(self):
+        """Returns the measurements as a dictionary of plain types."""
+
+        with self._lock:
+            return {
+                'stages': dict((name, {'calls': count, 'seconds': duration,
+                                       'max_seconds': longest})
+                               for name, (count, duration, longest) in
+                               self.stages.items()),
+                'api_calls': [{'method': method, 'endpoint': endpoint,
+                               'status': status, 'calls': count}
+                              for (method, endpoint, status), count in
+                              sorted(self.api_calls.items())],
+                'bytes_sent': dict(self.bytes_sent),
+                'retries': self.retries,
+            }
+
+    def report(self):
+        """Returns a human readable report of the measurements."""
+
+        summary = self.summary()
+
+        lines = ['{:<20}{:>8}{:>12}{:>12}{:>12}'.format(
+            'Stage', 'Calls', 'Total s', 'Mean ms', 'Max ms')]
+        for name, stage in sorted(summary['stages'].items()):
+            lines.append('{:<20}{:>8}{:>12.2f}{:>12.1f}{:>12.1f}'.format(
+                name, stage['calls'], stage['seconds'],
+                1000.0 * stage['seconds'] / max(stage['calls'], 1),
+                1000.0 * stage['max_seconds']))
+
+        lines.extend(['', '{:<20}{:>8}'.format('API call', 'Calls')])
+        for call in summary['api_calls']:
+            name = '{method} {endpoint} {status}'.format(**call)
+            lines.append('{:<20}{:>8}'.format(name, call['calls']))
+
+        lines.append('')
+        for endpoint, bytes_sent in sorted(summary['bytes_sent'].items()):
+            lines.append('Bytes sent to {}: {}'.format(endpoint, bytes_sent))
+        lines.append('Retries: {}'.format(summary['retries']))
+
+        return '\n'.join(lines)
+
+    def to_json(self):
+        """Returns the measurements as a JSON string."""
+        return json.dumps(self.summary(), indent=2, sort_keys=True)
+
+    def to_prometheus(self):
+        """Returns the measurements in the Prometheus text exposition
+        format."""
+
+        summary = self.summary()
+        prefix = self._prometheus_prefix
+
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            lines.append('# HELP {}_{} {}'.format(prefix, name, help_text))
+            lines.append('# TYPE {}_{} {}'.format(prefix, name, kind))
+            for labels, value in samples:
+                label_text = ','.join('{}="{}"'.format(key, label) for
+                                      key, label in labels)
+                if label_text:
+                    label_text = '{' + label_text + '}'
+                lines.append('{}_{}{} {}'.format(prefix, name, label_text,
+                                                 value))
+
+        stages = sorted(summary['stages'].items())
+        metric('stage_seconds_total', 'counter',
+               'Time spent in each stage.',
+               [((('stage', name),), stage['seconds']) for name, stage in
+                stages])
+        metric('stage_calls_total', 'counter',
+               'Number of times each stage ran.',
+               [((('stage', name),), stage['calls']) for name, stage in
+                stages])
+        metric('stage_max_seconds', 'gauge',
+               'Longest single run of each stage.',
+               [((('stage', name),), stage['max_seconds']) for name, stage
+                in stages])
+        metric('api_calls_total', 'counter',
+               'API calls by method, endpoint and status.',
+               [((('method', call['method']), ('endpoint', call['endpoint']),
+                  ('status', call['status'])), call['calls']) for call in
+                summary['api_calls']])
+        metric('api_bytes_sent_total', 'counter',
+               'Bytes of request bodies sent to each endpoint.',
+               [((('endpoint', endpoint),), bytes_sent) for endpoint,
+                bytes_sent in sorted(summary['bytes_sent'].items())])
+        metric('api_retries_total', 'counter',
+               'Requests retried after a transient failure.',
+               [((), summary['retries'])])
+
+        return '\n'.join(lines) + '\n'
+
+
+class RetryingAdapter(requests.adapters.HTTPAdapter):
+    """A transport adapter that every API request goes through. It waits
+    on the rate limiter before each request and retries requests that
+    failed transiently with jittered exponential backoff.
+
+    Requests the server throttled (429) or refused while unavailable (503)
+    are retried whatever their method, since they weren't processed. Other
+    server errors, timeouts and connection errors are only retried for
+    idempotent methods, so a file is never posted twice."""
+
+    _throttled_statuses = (429, 503)
+    _server_error_statuses = (500, 502, 504)
+    _idempotent_methods = ('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE')
+
+    def __init__(self, rate_limiter=None, retries=5, backoff=0.5,
+                 max_backoff=60.0, timeout=60.0, metrics=None, **kwargs):
+        """Initializes the adapter.
+
+        Parameters
+        ==========
+        rate_limiter : RateLimiter, optional, default=None
+            The limiter to wait on before each request.
+        retries : integer, optional, default=5
+            The maximum number of times a request is retried.
+        backoff : float, optional, default=0.5
+            The base of the backoff in seconds, the n-th retry waits a
+            random time up to backoff * 2 ** n.
+        max_backoff : float, optional, default=60.0
+            The longest time to wait before a retry.
+        timeout : float, optional, default=60.0
+            The timeout in seconds for requests that don't set their own.
+        metrics : RunMetrics, optional, default=None
+            If given, the retries are counted in it.
+        kwargs
+            Passed on to requests.adapters.HTTPAdapter.
+
+        """
+        super(RetryingAdapter, self).__init__(**kwargs)
+        self.rate_limiter = rate_limiter
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self.metrics = metrics
+
+    def send(self, request, **kwargs):
+        """Sends the request, retrying it if it fails transiently."""
+
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.timeout
+
+        idempotent = request.method in self._idempotent_methods
+
+        attempt = 0
+        while True:
+            if self.rate_limiter is not None:
+                self.rate_limiter.acquire()
+
+            retry_after = None
+
+            try:
+                response = super(RetryingAdapter, self).send(request,
+                                                             **kwargs)
+            except (requests.exceptions.ConnectionError,
+                    requests.exceptions.Timeout):
+                if not idempotent or attempt >= self.retries:
+                    raise
+            else:
+                status = response.status_code
+                if status in self._throttled_statuses:
+                    if self.rate_limiter is not None:
+                        self.rate_limiter.slow_down()
+                    retry_after = response.headers.get('Retry-After')
+                elif not (status in self._server_error_statuses and
+                          idempotent):
+                    if self.rate_limiter is not None and status < 400:
+                        self.rate_limiter.speed_up()
+                    return response
+                if attempt >= self.retries:
+                    return response
+                response.close()
+
+            delay = random.uniform(0, min(self.max_backoff,
+                                          self.backoff * 2 ** attempt))
+            if retry_after is not None and retry_after.isdigit():
+                delay = max(delay, float(retry_after))
+
+            print("Retrying {} {} in {:.1f} seconds.".format(
+                request.method, request.url, delay))
+            if self.metrics is not None:
+                self.metrics.record_retry()
+            time.sleep(delay)
+            attempt += 1
+
+
+class PageCache(object):
+    """The page dictionaries fetched from or written to the server during a
+    run, keyed by page name and by slug, so that a page is only fetched
+    again when a write needs its latest content."""
+
+    _batch_size = 50
+
+    def __init__(self, api):
+        """Initializes an empty cache.
+
+        Parameters
+        ==========
+        api : slumber.API
+            The API the pages are fetched from.
+
+        """
+        self.api = api
+        self.by_name = {}
+        self.by_slug = {}
+
+    def clear(self):
+        """Forgets all the cached pages."""
+        self.by_name = {}
+        self.by_slug = {}
+
+    def store(self, page, page_name=None):
+        """Caches a page dictionary and returns it.
+
+        Parameters
+        ==========
+        page : dictionary
+            The page as returned by the API.
+        page_name : string, optional, default=None
+            The name the page was requested by, if it differs from the name
+            of the page, e.g. in case.
+
+        """
+        self.by_name[page['name']] = page
+        self.by_slug[page['slug']] = page
+        if page_name is not None:
+            self.by_name[page_name] = page
+        return page
+
+    def get(self, page_name, fresh=False):
+        """Returns the page dictionary, fetching it if it isn't cached.
+        Raises slumber.exceptions.HttpClientError if the page doesn't
+        exist.
+
+        Parameters
+        ==========
+        page_name : string
+            The name of the page.
+        fresh : boolean, optional, default=False
+            If true, the page is fetched even if it is cached.
+
+        """
+        if not fresh and page_name in self.by_name:
+            return self.by_name[page_name]
+
+        return self.store(self.api.page(page_name).get(), page_name)
+
+    def get_many(self, page_names):
+        """Returns a dictionary mapping each of the page names to its page
+        dictionary, or to None if the page doesn't exist. The pages that
+        aren't cached are fetched in batches with a slug__in filter, so a
+        name that differs from the page's only in case still finds it.
+        Names with commas in them are fetched one at a time.
+
+        Parameters
+        ==========
+        page_names : iterable of strings
+            The names of the pages.
+
+        """
+        pages = {}
+        batch = []
+
+        for page_name in sorted(set(page_names)):
+            slug = _slugify(page_name)
+            if page_name in self.by_name:
+                pages[page_name] = self.by_name[page_name]
+            elif slug in self.by_slug:
+                pages[page_name] = self.store(self.by_slug[slug], page_name)
+            elif ',' in page_name:
+                try:
+                    pages[page_name] = self.get(page_name)
+                except slumber.exceptions.HttpClientError as error:
+                    if not _is_not_found(error):
+                        raise
+                    pages[page_name] = None
+            else:
+                batch.append(page_name)
+
+        for chunk in _chunks(batch, self._batch_size):
+            slugs = sorted(set(_slugify(page_name) for page_name in chunk))
+            response = self.api.page.get(slug__in=','.join(slugs), limit=0)
+            found = dict((page['slug'], self.store(page)) for page in
+                         response['objects'])
+            for page_name in chunk:
+                page = found.get(_slugify(page_name))
+                if page is not None:
+                    self.store(page, page_name)
+                pages[page_name] = page
+
+        return pages
+
+    def update(self, page_name, response, changes=None):
+        """Updates the cache after a page was posted or patched and returns
+        the page. If the server returned the page it is cached as is,
+        otherwise the changes that were sent are applied to the cached
+        page. The page is only fetched if neither is possible.
+
+        Parameters
+        ==========
+        page_name : string
+            The name of the page.
+        response : dictionary or None
+            The response to the post or patch.
+        changes : dictionary, optional, default=None
+            The fields that were sent in a patch.
+
+        """
+        if isinstance(response, dict) and 'slug' in response:
+            return self.store(response, page_name)
+        elif changes is not None and page_name in self.by_name:
+            page = self.by_name[page_name]
+            page.update(changes)
+            return page
+        else:
+            return self.get(page_name, fresh=True)
+
+
+class ScanIndex(object):
+    """An SQLite index of the image files that have been scanned, keyed by
+    path, modification time and size, so that the metadata of files that
+    haven't changed since the last run doesn't have to be read again. It
+    also keeps the content hash of each file once it has been computed.
+    Files whose headers showed they can't have the main keyword are kept
+    as untagged for that keyword only."""
+
+    def __init__(self, path):
+        """Opens the index, creating it if it doesn't exist.
+
+        Parameters
+        ==========
+        path : string
+            The path to the SQLite database file.
+
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        # The connection is guarded by the lock, so any thread may use it.
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        columns = [row[1] for row in self.connection.execute(
+            "PRAGMA table_info(images)")]
+        if columns and 'caption' not in columns:
+            # An index from before the whole record was kept, the files
+            # are simply read again.
+            self.connection.execute("DROP TABLE images")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS images ("
+            "path TEXT PRIMARY KEY, mtime REAL, size INTEGER, "
+            "keywords TEXT, page_names TEXT, template TEXT, "
+            "orientation TEXT, width INTEGER, height INTEGER, caption TEXT, "
+            "hash TEXT, keyword TEXT)")
+        for column in ('hash', 'keyword'):
+            if columns and 'caption' in columns and column not in columns:
+                # The records are still good, the new columns are filled
+                # in as the files are hashed or found untagged.
+                self.connection.execute(
+                    "ALTER TABLE images ADD COLUMN {} TEXT".format(column))
+        self.connection.commit()
+
+    def partition(self, file_paths, keyword=None):
+        """Splits the files into those whose records are in the index and
+        up to date, and those that need to be read.
+
+        Parameters
+        ==========
+        file_paths : list of strings
+            The paths to the image files.
+        keyword : string, optional, default=None
+            The main keyword of the scan. Files stored as untagged for a
+            different keyword need to be read again.
+
+        Returns
+        =======
+        known : dictionary
+            Maps the paths of the unchanged files to their ImageRecord.
+        unknown : dictionary
+            Maps the paths of new or changed files to a tuple of their
+            modification time and size.
+
+        """
+        known = {}
+        unknown = {}
+
+        with self._lock:
+            for file_path in file_paths:
+                stat = os.stat(file_path)
+                row = self.connection.execute(
+                    "SELECT keywords, page_names, template, orientation, "
+                    "width, height, caption, keyword FROM images WHERE "
+                    "path = ? AND mtime = ? AND size = ?",
+                    (os.path.abspath(file_path), stat.st_mtime,
+                     stat.st_size)).fetchone()
+                if row is None or (row[7] is not None and
+                                   row[7] != keyword):
+                    unknown[file_path] = (stat.st_mtime, stat.st_size)
+                else:
+                    known[file_path] = ImageRecord(
+                        json.loads(row[0]), json.loads(row[1]), *row[2:7])
+
+        return known, unknown
+
+    def store(self, file_path, mtime, size, record):
+        """Records the ImageRecord read from a file."""
+
+        with self._lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO images (path, mtime, size, keywords, "
+                "page_names, template, orientation, width, height, caption) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (os.path.abspath(file_path), mtime, size,
+                 json.dumps(record.keywords), json.dumps(record.page_names),
+                 record.template, record.orientation, record.width,
+                 record.height, record.caption))
+
+    def store_untagged(self, file_path, mtime, size, keyword):
+        """Records that the header of the file showed it can't have the
+        keyword, without reading the rest of its metadata."""
+
+        with self._lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO images (path, mtime, size, keywords, "
+                "page_names, keyword) VALUES (?, ?, ?, ?, ?, ?)",
+                (os.path.abspath(file_path), mtime, size, '[]', '[]',
+                 keyword))
+
+    def content_hash(self, file_path):
+        """Returns the content hash of the file. It is only computed if
+        the file changed since it was last hashed, and then kept in the
+        file's record, if it has one, until commit is called."""
+
+        stat = os.stat(file_path)
+        abs_path = os.path.abspath(file_path)
+
+        with self._lock:
+            row = self.connection.execute(
+                "SELECT hash FROM images WHERE path = ? AND mtime = ? AND "
+                "size = ?", (abs_path, stat.st_mtime,
+                             stat.st_size)).fetchone()
+
+        if row is not None and row[0] is not None:
+            return row[0]
+
+        content_hash = _file_hash(file_path)
+
+        if row is not None:
+            with self._lock:
+                self.connection.execute(
+                    "UPDATE images SET hash = ? WHERE path = ?",
+                    (content_hash, abs_path))
+
+        return content_hash
+
+    def commit(self):
+        """Writes the stored records to disk."""
+        with self._lock:
+            self.connection.commit()
+
+    def close(self):
+        """Closes the database."""
+        with self._lock:
+            self.connection.close()
+
+
+def _file_hash(file_path):
+    """Returns the SHA-1 hex digest of the contents of a file."""
+
+    sha1 = hashlib.sha1()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+class ContentHashIndex(object):
+    """An SQLite map from the content hashes of uploaded images and the
+    pages they were uploaded to, to the names they have on the server, so
+    that uploads are identified by content rather than by file name. It
+    also lists the files the uploader posted itself, as only those are
+    known to be the images they are named after, and the pages it created,
+    so that clean_up_localwiki.py can remove exactly what it added."""
+
+    def __init__(self, path=None):
+        """Opens the index, creating it if it doesn't exist.
+
+        Parameters
+        ==========
+        path : string, optional, default=None
+            The path to the SQLite database file. If None, the index is
+            only kept in memory.
+
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        # Names claimed during this run but not uploaded yet.
+        self._claims = {}
+        # The uploads in the pipelined mode record hashes from other
+        # threads.
+        self.connection = sqlite3.connect(':memory:' if path is None else
+                                          path, check_same_thread=False)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS uploads ("
+            "hash TEXT, page_name TEXT, name TEXT, "
+            "PRIMARY KEY (hash, page_name))")
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS uploads_name ON uploads (name)")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS posted ("
+            "slug TEXT, name TEXT, PRIMARY KEY (slug, name))")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS created (slug TEXT PRIMARY KEY)")
+        self.connection.commit()
+
+    def lookup(self, content_hash, page_name):
+        """Returns the name the image was uploaded to the page under, or
+        None if it wasn't."""
+
+        with self._lock:
+            row = self.connection.execute(
+                "SELECT name FROM uploads WHERE hash = ? AND page_name = ?",
+                (content_hash, page_name)).fetchone()
+
+        return None if row is None else row[0]
+
+    def hashes_for_name(self, name):
+        """Returns the set of hashes of the images uploaded or claimed
+        under the name."""
+
+        with self._lock:
+            rows = self.connection.execute(
+                "SELECT hash FROM uploads WHERE name = ?", (name,)).fetchall()
+            hashes = set(row[0] for row in rows)
+            hashes.update(self._claims.get(name, set()))
+
+        return hashes
+
+    def claim(self, content_hash, name):
+        """Reserves the name for the image for the rest of the run."""
+
+        with self._lock:
+            self._claims.setdefault(name, set()).add(content_hash)
+
+    def clear_claims(self):
+        """Forgets the names reserved in the last run."""
+
+        with self._lock:
+            self._claims = {}
+
+    def record(self, content_hash, page_name, name):
+        """Commits that the image is on the page under the name."""
+
+        with self._lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO uploads (hash, page_name, name) "
+                "VALUES (?, ?, ?)", (content_hash, page_name, name))
+            self.connection.commit()
+
+    def record_post(self, slug, name):
+        """Commits that the uploader posted a file under the name to the
+        page with the slug."""
+
+        with self._lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO posted (slug, name) VALUES (?, ?)",
+                (slug, name))
+            self.connection.commit()
+
+    def was_posted(self, slug, name):
+        """Returns true if the uploader posted the file under the name to
+        the page with the slug."""
+
+        with self._lock:
+            row = self.connection.execute(
+                "SELECT 1 FROM posted WHERE slug = ? AND name = ?",
+                (slug, name)).fetchone()
+
+        return row is not None
+
+    def record_created(self, slug):
+        """Commits that the uploader created the page with the slug."""
+
+        with self._lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO created (slug) VALUES (?)", (slug,))
+            self.connection.commit()
+
+    def close(self):
+        """Closes the database."""
+        with self._lock:
+            self.connection.close()
+
+
+def default_hash_index_path(api_url):
+    """Returns the path of the hash index the command line keeps for a
+    wiki when none is given, a file in the home directory named after the
+    host of the API url."""
+
+    host = urlparse(api_url).netloc.replace(':', '-')
+    return os.path.join(os.path.expanduser('~'),
+                        '.localwiki-hashes-{}.db'.format(host))
+
+
+class UploadJournal(object):
+    """An SQLite journal of the steps completed for each image and page
+    pair during an upload. Each step is committed as soon as it is done,
+    so a run that is interrupted can be resumed without repeating the API
+    calls that already succeeded."""
+
+    NOT_STARTED = 0
+    PAGE_CREATED = 1
+    UPLOADED = 2
+    EMBEDDED = 3
+
+    def __init__(self, path):
+        """Opens the journal, creating it if it doesn't exist.
+
+        Parameters
+        ==========
+        path : string
+            The path to the SQLite database file.
+
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        # The uploads in the pipelined mode record steps from other threads.
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS steps ("
+            "path TEXT, page_name TEXT, step INTEGER, slug TEXT, "
+            "PRIMARY KEY (path, page_name))")
+        self.connection.commit()
+
+    def record(self, file_path, page_name, step, slug):
+        """Commits that the step is done for the image and page.
+
+        Parameters
+        ==========
+        file_path : string
+            The path to the original image file.
+        page_name : string
+            The name of the page.
+        step : integer
+            One of PAGE_CREATED, UPLOADED or EMBEDDED.
+        slug : string
+            The slug of the page.
+
+        """
+        with self._lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO steps (path, page_name, step, slug) "
+                "VALUES (?, ?, ?, ?)",
+                (os.path.abspath(file_path), page_name, step, slug))
+            self.connection.commit()
+
+    def step(self, file_path, page_name):
+        """Returns the last step done for the image and page, and the slug
+        of the page if it is known."""
+
+        with self._lock:
+            row = self.connection.execute(
+                "SELECT step, slug FROM steps WHERE path = ? AND "
+                "page_name = ?",
+                (os.path.abspath(file_path), page_name)).fetchone()
+
+        if row is None:
+            return self.NOT_STARTED, None
+        else:
+            return row[0], row[1]
+
+    def clear(self):
+        """Removes all the recorded steps."""
+        with self._lock:
+            self.connection.execute("DELETE FROM steps")
+            self.connection.commit()
+
+    def close(self):
+        """Closes the database."""
+        with self._lock:
+            self.connection.close()
+
+
+class PageSerializer(object):
+    """Runs jobs on a thread pool such that the jobs for any one page run
+    one at a time and in the order they were submitted, while jobs for
+    different pages run concurrently."""
+
+    def __init__(self, pool):
+        """Initializes the serializer.
+
+        Parameters
+        ==========
+        pool : multiprocessing.pool.ThreadPool
+            The pool the jobs run on.
+
+        """
+        self.pool = pool
+        self._lock = threading.Lock()
+        self._queues = {}
+        self._results = []
+        self._errors = []
+
+    def submit(self, page_name, function, *args):
+        """Queues function(*args) to run after the previously submitted
+        jobs for this page."""
+
+        with self._lock:
+            if page_name in self._queues:
+                self._queues[page_name].append((function, args))
+                return
+            self._queues[page_name] = collections.deque([(function, args)])
+
+        self._results.append(self.pool.apply_async(self._drain,
+                                                   (page_name,)))
+
+    def _drain(self, page_name):
+        """Runs the queued jobs for a page until there are none left."""
+
+        while True:
+            with self._lock:
+                queue = self._queues[page_name]
+                if not queue:
+                    del self._queues[page_name]
+                    return
+                function, args = queue.popleft()
+            try:
+                function(*args)
+            except Exception as error:
+                print("Failed to upload to {}: {}".format(page_name, error))
+                self._errors.append(error)
+
+    def join(self):
+        """Waits for all the submitted jobs to finish and raises the first
+        error, if any of them failed."""
+
+        for result in self._results:
+            result.get()
+
+        if self._errors:
+            raise self._errors[0]
+
+
+class DirectoryWatcher(object):
+    """Reports the image files that are created, changed or removed in a set
+    of directories, using inotify if pyinotify is installed and polling the
+    modification times of the files otherwise. The changes are reported in
+    batches once the files have been quiet for the debounce period, so a
+    photo that is still being written, or whose tags are saved in several
+    steps, is reported once."""
+
+    def __init__(self, directories, list_files, is_watched, recursive=False,
+                 debounce=2.0, poll_interval=5.0, use_inotify=True):
+        """Initializes the watcher, the directories are watched from the
+        call to changes.
+
+        Parameters
+        ==========
+        directories : list of strings
+            The paths to the directories to watch.
+        list_files : function
+            Takes a directory and returns the paths to the image files in
+            it, used when polling.
+        is_watched : function
+            Takes the path of a file that changed and returns true if it is
+            an image file of interest, used with inotify.
+        recursive : boolean, optional, default=False
+            If true, the subdirectories are watched too.
+        debounce : float, optional, default=2.0
+            The number of seconds without further changes before a batch is
+            reported.
+        poll_interval : float, optional, default=5.0
+            The number of seconds between polls when inotify isn't used.
+        use_inotify : boolean, optional, default=True
+            If false, the directories are polled even if pyinotify is
+            installed.
+
+        """
+        self.directories = list(directories)
+        self.list_files = list_files
+        self.is_watched = is_watched
+        self.recursive = recursive
+        self.debounce = debounce
+        self.poll_interval = poll_interval
+        self.use_inotify = use_inotify and pyinotify is not None
+
+        self._notifier = None
+        self._snapshot = None
+        self._events = []
+
+    def changes(self):
+        """Starts watching and returns a generator that yields a tuple of
+        the set of paths that were created or changed and the set of paths
+        that were removed, each time a batch of changes has settled. It
+        runs until close is called or the generator is closed."""
+
+        if self.use_inotify:
+            self._start_inotify()
+            return self._batches(self._poll_inotify)
+        else:
+            self._snapshot = self._take_snapshot()
+            return self._batches(self._poll_files)
+
+    def _batches(self, poll):
+        """Yields the changes returned by poll in debounced batches."""
+
+        changed = set()
+        removed = set()
+        last_change = None
+
+        try:
+            while self._notifier is not None or self._snapshot is not None:
+
+                new_changed, new_removed = poll()
+
+                if new_changed or new_removed:
+                    # A file that is removed and written again, as some
+                    # programs save files, counts as changed.
+                    changed = (changed - new_removed) | new_changed
+                    removed = (removed - new_changed) | new_removed
+                    last_change = time.time()
+
+                if ((changed or removed) and
+                        time.time() - last_change >= self.debounce):
+                    yield changed, removed
+                    changed = set()
+                    removed = set()
+        finally:
+            self.close()
+
+    def close(self):
+        """Stops watching."""
+
+        if self._notifier is not None:
+            self._notifier.stop()
+            self._notifier = None
+        self._snapshot = None
+
+    def _start_inotify(self):
+
+        watch_manager = pyinotify.WatchManager()
+        mask = (pyinotify.IN_CLOSE_WRITE | pyinotify.IN_MOVED_TO |
+                pyinotify.IN_MOVED_FROM | pyinotify.IN_DELETE |
+                pyinotify.IN_CREATE)
+        self._notifier = pyinotify.Notifier(
+            watch_manager, default_proc_fun=self._events.append,
+            timeout=int(1000 * min(self.debounce, 1.0)))
+        watch_manager.add_watch(self.directories, mask, rec=self.recursive,
+                                auto_add=self.recursive)
+
+    def _poll_inotify(self):
+        """Waits up to a second for events and returns the watched paths
+        they changed and removed."""
+
+        notifier = self._notifier
+        if notifier is None:
+            return set(), set()
+
+        if notifier.check_events():
+            notifier.read_events()
+            notifier.process_events()
+
+        changed = set()
+        removed = set()
+
+        removing = pyinotify.IN_DELETE | pyinotify.IN_MOVED_FROM
+
+        for event in self._events:
+            # Files being created are reported when they are closed.
+            if event.dir or event.mask & pyinotify.IN_CREATE:
+                continue
+            if not self.is_watched(event.pathname):
+                continue
+            if event.mask & removing:
+                changed.discard(event.pathname)
+                removed.add(event.pathname)
+            else:
+                removed.discard(event.pathname)
+                changed.add(event.pathname)
+
+        del self._events[:]
+
+        return changed, removed
+
+    def _take_snapshot(self):
+        """Returns a dictionary mapping the path of every image file to its
+        modification time and size."""
+
+        snapshot = {}
+        for directory in self.directories:
+            for file_path in self.list_files(directory):
+                try:
+                    stat = os.stat(file_path)
+                except OSError:  # removed while listing
+                    continue
+                snapshot[file_path] = (stat.st_mtime, stat.st_size)
+        return snapshot
+
+    def _poll_files(self):
+        """Waits for the poll interval and returns the paths that changed
+        and were removed since the last poll."""
+
+        time.sleep(self.poll_interval)
+
+        previous = self._snapshot
+        if previous is None:
+            return set(), set()
+
+        snapshot = self._take_snapshot()
+
+        changed = set(path for path, stat in snapshot.items() if
+                      previous.get(path) != stat)
+        removed = set(previous) - set(snapshot)
+
+        self._snapshot = snapshot
+
+        return changed, removed
+
+
+class DecodeBudget(object):
+    """Limits the memory taken by the images that are decoded at the same
+    time, across all the processes sharing the budget. Each decode reserves
+    its estimated size first and waits while the budget is taken up by
+    others; an image larger than the whole budget waits to be decoded
+    alone. It has to be handed to worker processes when they are started,
+    e.g. through the initializer of a pool."""
+
+    def __init__(self, megabytes):
+        """Initializes the budget.
+
+        Parameters
+        ==========
+        megabytes : integer
+            The total size of the decoded images in memory at any time, in
+            megabytes.
+
+        """
+        self.megabytes = max(1, int(megabytes))
+        self._tokens = multiprocessing.Semaphore(self.megabytes)
+        self._lock = multiprocessing.Lock()
+
+    @contextlib.contextmanager
+    def reserve(self, num_bytes):
+        """A context manager that holds num_bytes of the budget for its
+        block."""
+
+        tokens = min(self.megabytes,
+                     max(1, int(math.ceil(num_bytes / 2.0 ** 20))))
+
+        # Only one process gathers tokens at a time, so two large images
+        # can't each hold part of the budget and wait for the other.
+        with self._lock:
+            for i in range(tokens):
+                self._tokens.acquire()
+        try:
+            yield
+        finally:
+            for i in range(tokens):
+                self._tokens.release()
+
+
+# The decode budget of a worker process, set by _init_worker.
+_worker_decode_budget = None
+
+
+@contextlib.contextmanager
+def _reserve_decode(decode_budget, num_bytes):
+    """Holds num_bytes of the decode budget for the block, if there is a
+    budget."""
+    if decode_budget is None:
+        yield
+    else:
+        with decode_budget.reserve(num_bytes):
+            yield
+
+
+def _init_worker(decode_budget):
+    """Sets up a process of the image preparation pool."""
+    global _worker_decode_budget
+    _worker_decode_budget = decode_budget
+    # A spawned process doesn't share the parent's setup.
+    _initialize_exiv2()
+
+
+def _prepare_image(args):
+    """Runs ImageUploader.prepare_image on a (file_path, in_memory, record,
+    derivative_widths) tuple, this is a module level function so that it
+    can be sent to a process pool. Returns the result and the stage timings
+    measured in the worker."""
+    file_path, in_memory, record, derivative_widths = args
+    metrics = RunMetrics()
+    result = ImageUploader.prepare_image(file_path, in_memory=in_memory,
+                                         metrics=metrics,
+                                         decode_budget=_worker_decode_budget,
+                                         record=record,
+                                         derivative_widths=derivative_widths)
+    return result, metrics.stages
+
+
+class _PreparedResult(object):
+    """Stands in for the AsyncResult of an image that was prepared
+    before the upload started."""
+
+    def __init__(self, value):
+        self._value = value
+
+    def ready(self):
+        return True
+
+    def get(self):
+        return self._value
+
+
+def _read_jpeg_segments(f):
+    """Returns a list of (marker, segment) tuples for the marker segments
+    that come before the image data of a JPEG file, where each segment
+    includes its marker and length bytes. The list is empty if the file
+    isn't a JPEG.
+
+    Parameters
+    ==========
+    f : file
+        The image file opened in binary mode, positioned at its start.
+
+    """
+
+    if f.read(2) != b'\xff\xd8':
+        return []
+
+    segments = []
+    while True:
+        header = f.read(4)
+        if len(header) < 4 or header[0:1] != b'\xff':
+            break
+        marker = ord(header[1:2])
+        # Start of scan or end of image, the rest is image data.
+        if marker in (0xDA, 0xD9):
+            break
+        length = struct.unpack('>H', header[2:4])[0]
+        segments.append((marker, header + f.read(length - 2)))
+
+    return segments
+
+
+def _insert_jpeg_segments(data, segments):
+    """Returns the JPEG data with the segments inserted after its leading
+    application segments."""
+
+    position = 2
+    while (data[position:position + 1] == b'\xff' and
+           0xE0 <= ord(data[position + 1:position + 2]) <= 0xEF):
+        length = struct.unpack('>H', data[position + 2:position + 4])[0]
+        position += 2 + length
+
+    return data[:position] + b''.join(segments) + data[position:]
+
+
+def _exif_entries(data, ifd_offset):
+    """Yields the tag, type and data offset of each entry in an Exif image
+    file directory, where data is the TIFF structure of the Exif segment
+    as a bytearray."""
+
+    endian = '<' if data[0:2] == b'II' else '>'
+    count = struct.unpack_from(endian + 'H', data, ifd_offset)[0]
+    for i in range(count):
+        entry = ifd_offset + 2 + 12 * i
+        tag, tag_type = struct.unpack_from(endian + 'HH', data, entry)
+        yield tag, tag_type, entry + 8
+
+
+def _exif_tiff(exif):
+    """Returns the TIFF structure of a raw Exif segment as a bytearray and
+    the offset of its first image file directory."""
+
+    data = bytearray(exif[6:] if exif[:6] == b'Exif\x00\x00' else exif)
+    endian = '<' if data[0:2] == b'II' else '>'
+    return data, struct.unpack_from(endian + 'I', data, 4)[0]
+
+
+def _exif_orientation(exif):
+    """Returns the orientation stored in a raw Exif segment, or None if
+    there isn't one."""
+
+    try:
+        data, ifd_offset = _exif_tiff(exif)
+        endian = '<' if data[0:2] == b'II' else '>'
+        for tag, tag_type, offset in _exif_entries(data, ifd_offset):
+            if tag == 0x0112:
+                return struct.unpack_from(endian + 'H', data, offset)[0]
+    except struct.error:
+        pass
+
+    return None
+
+
+def _update_exif(exif, size, rotated):
+    """Returns a copy of a raw Exif segment with the pixel dimensions set
+    to the new size and, if the image was rotated, the orientation set to
+    upright. The values are replaced in place, so the rest of the segment
+    is left untouched."""
+
+    try:
+        data, ifd_offset = _exif_tiff(exif)
+        endian = '<' if data[0:2] == b'II' else '>'
+        exif_ifd_offset = None
+        for tag, tag_type, offset in _exif_entries(data, ifd_offset):
+            if tag == 0x0112 and rotated:
+                struct.pack_into(endian + 'H', data, offset, 1)
+            elif tag == 0x8769:
+                exif_ifd_offset = struct.unpack_from(endian + 'I', data,
+                                                     offset)[0]
+        if exif_ifd_offset is not None:
+            dimensions = {0xA002: size[0], 0xA003: size[1]}
+            for tag, tag_type, offset in _exif_entries(data,
+                                                       exif_ifd_offset):
+                if tag in dimensions:
+                    # The dimensions are either a short or a long.
+                    struct.pack_into(endian + ('H' if tag_type == 3 else 'I'),
+                                     data, offset, dimensions[tag])
+    except struct.error:
+        return exif
+
+    return b'Exif\x00\x00' + bytes(data)
+
+
+def _chunks(iterable, size):
+    """Yields lists of up to size items from the iterable."""
+
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _page_templates(wiki_images):
+    """Returns a dictionary mapping the name of each page the images belong
+    on to the template it is created with, the template of the first
+    image, in order of path, that has one, or None.
+
+    Parameters
+    ==========
+    wiki_images : dictionary
+        The output of find_localwiki_images.
+
+    """
+
+    page_templates = {}
+    for file_path in sorted(wiki_images.keys()):
+        page_names, template_name = wiki_images[file_path]
+        for page_name in page_names:
+            if page_templates.get(page_name) is None:
+                page_templates[page_name] = template_name
+    return page_templates
+
+
+class ImageRecord(collections.namedtuple('ImageRecord', [
+        'keywords', 'page_names', 'template', 'orientation', 'width',
+        'height', 'caption'])):
+    """Everything the uploader needs from the metadata of an image: its
+    IPTC keywords, the page names and template they name, the Exif
+    orientation, the pixel size as stored and the IPTC caption, or None.
+    It is read once, when the image is scanned, and handed to the later
+    stages so the metadata isn't parsed again."""
+
+    __slots__ = ()
+
+    @classmethod
+    def from_metadata(cls, metadata):
+        """Makes a record from a GExiv2.Metadata."""
+
+        keywords = metadata.get_tag_multiple('Iptc.Application2.Keywords')
+        page_names, template = ImageUploader.parse_keywords(keywords)
+
+        if 'Iptc.Application2.Caption' in metadata.get_iptc_tags():
+            caption = metadata['Iptc.Application2.Caption']
+        else:
+            caption = None
+
+        return cls(keywords, page_names, template,
+                   metadata.get('Exif.Image.Orientation', '1'),
+                   metadata.get_pixel_width(), metadata.get_pixel_height(),
+                   caption)
+
+
+def _read_image_record(file_path):
+    """Returns the ImageRecord of an image file, this is a module level
+    function so that it can be sent to a worker pool."""
+    return ImageRecord.from_metadata(GExiv2.Metadata(file_path))
+
+
+def _read_tagged_image_record(args):
+    """Returns the ImageRecord of the image file in a (file_path, keyword)
+    tuple, or None if a look at its header shows that it can't have the
+    keyword. This is a module level function so that it can be sent to a
+    worker pool."""
+    file_path, keyword = args
+    if not _may_have_keyword(file_path, keyword):
+        return None
+    return _read_image_record(file_path)
+
+
+def _may_have_keyword(file_path, keyword):
+    """Returns false if the IPTC keywords of the image can't include the
+    keyword, judging only from the APP13 segments of a JPEG or the text
+    chunks of a PNG, which is much cheaper than a full metadata parse.
+    Returns true whenever in doubt, e.g. for other formats or headers that
+    can't be followed.
+
+    Parameters
+    ==========
+    file_path : string
+        The path to the image file.
+    keyword : string
+        The keyword to look for.
+
+    """
+
+    if keyword is None:
+        return True
+
+    if isinstance(keyword, bytes):
+        needles = [keyword]
+    else:
+        needles = [keyword.encode('utf-8')]
+        try:
+            needles.append(keyword.encode('latin-1'))
+        except UnicodeEncodeError:
+            pass
+
+    with open(file_path, 'rb') as f:
+        signature = f.read(8)
+        f.seek(0)
+        if signature[:2] == b'\xff\xd8':
+            blocks = _jpeg_iptc_blocks(f)
+        elif signature == b'\x89PNG\r\n\x1a\n':
+            blocks = _png_text_blocks(f)
+        else:
+            return True
+
+    if blocks is None:
+        return True
+
+    return any(needle in block for block in blocks for needle in needles)
+
+
+def _jpeg_iptc_blocks(f):
+    """Returns the contents of the APP13 segments, where the IPTC data is
+    kept, of a JPEG file positioned at its start. The other segments are
+    skipped without being read. Returns None if the header can't be
+    followed up to the image data."""
+
+    f.read(2)
+
+    blocks = []
+    while True:
+        header = f.read(4)
+        if len(header) < 4 or header[0:1] != b'\xff':
+            return None
+        marker = ord(header[1:2])
+        # Start of scan or end of image, the rest is image data.
+        if marker in (0xDA, 0xD9):
+            return blocks
+        if marker < 0xC0 or marker == 0xFF:
+            return None
+        length = struct.unpack('>H', header[2:4])[0]
+        if marker == 0xED:
+            blocks.append(f.read(length - 2))
+        else:
+            f.seek(length - 2, 1)
+
+
+def _png_text_blocks(f):
+    """Returns the text of the tEXt, zTXt and iTXt chunks of a PNG file
+    positioned at its start, decompressed, and with the hexadecimal raw
+    profiles, where the IPTC data is kept, decoded. The other chunks are
+    skipped without being read. Returns None if the chunks can't be
+    followed or decoded."""
+
+    f.read(8)
+
+    blocks = []
+    while True:
+        header = f.read(8)
+        if len(header) < 8:
+            return None
+        length, chunk_type = struct.unpack('>I4s', header)
+        if chunk_type == b'IEND':
+            return blocks
+        if chunk_type not in (b'tEXt', b'zTXt', b'iTXt'):
+            f.seek(length + 4, 1)
+            continue
+
+        data = f.read(length)
+        f.seek(4, 1)  # the CRC
+
+        name, _, rest = data.partition(b'\x00')
+        try:
+            if chunk_type == b'tEXt':
+                text = rest
+            elif chunk_type == b'zTXt':
+                text = zlib.decompress(rest[1:])
+            else:
+                compressed = rest[0:1] == b'\x01'
+                language, _, rest = rest[2:].partition(b'\x00')
+                translated_name, _, text = rest.partition(b'\x00')
+                if compressed:
+                    text = zlib.decompress(text)
+            if name.startswith(b'Raw profile type'):
+                # A newline, the profile name, the length and then the
+                # data in lines of hexadecimal digits.
+                hex_digits = b''.join(text.split(b'\n', 3)[3].split())
+                text = binascii.unhexlify(hex_digits)
+        except (zlib.error, IndexError, TypeError, ValueError):
+            return None
+
+        blocks.append(name + b'\x00' + text)
+
+
 class ImageUploader(object):
 
     _tmp_dir_name = '.localwiki'
     # The code may only work with jpegs do to reliance on Exif metadata.
     _file_extensions = ['.png', '.jpg', '.gif', '.jpeg']
     _stub_page_content = "<p>This page is a stub, please add some content to help describe this page.</p>"
+    _default_caption = 'Caption me!'
+    # The number of files whose keywords are read as a batch when scanning.
+    _scan_chunk_size = 1000
+    # The maximum width of an uploaded image in pixels.
+    _max_width = 1024
+    # The transposes that make an image upright for each Exif orientation.
+    _orientation_transposes = {2: Image.FLIP_LEFT_RIGHT,
+                               3: Image.ROTATE_180,
+                               4: Image.FLIP_TOP_BOTTOM,
+                               5: Image.TRANSPOSE,
+                               6: Image.ROTATE_270,
+                               7: Image.TRANSVERSE,
+                               8: Image.ROTATE_90}
+
+    def __init__(self, api_url, user_name=None, api_key=None,
+                 file_index_path=None, file_index_max_age=3600.0,
+                 scan_index_path=None, session=None, pool_size=10,
+                 journal_path=None, hash_index_path=None, rate_limit=None,
+                 retries=5, metrics=None):
+        """Initializes the uploader.
+
+        Parameters
+        ==========
+        api_url : string
+            This should point to your API and have a trailing slash, e.g.
+            'http://clevelandwiki.org/api/'.
+        user_name : string, optional, default=None
+            The user name for you API key. If you don't provide this here,
+            then you will be prompted to enter it on initialization.
+        api_key : string, optional, default=None
+            The api_key for this user. If you don't provide this here, then
+            you will be prompted to enter it on initialization.
+        file_index_path : string, optional, default=None
+            A path to a JSON file where the listing of the files on the
+            server is cached between runs. If None, the listing is fetched
+            once per uploader.
+        file_index_max_age : float, optional, default=3600.0
+            The number of seconds before the cached file listing is
+            considered stale.
+        scan_index_path : string, optional, default=None
+            A path to an SQLite database where the keywords of the scanned
+            images are kept between runs, so that only new or changed files
+            are read. If None, every file is read on each run.
+        session : requests.Session, optional, default=None
+            The HTTP session used for all the API requests, e.g. one that is
+            set up for a proxy. If None, a keep-alive session with a
+            connection pool of pool_size is made.
+        pool_size : integer, optional, default=10
+            The number of connections kept open to the server when the
+            session is made here. It is grown to match the upload
+            concurrency if needed.
+        journal_path : string, optional, default=None
+            A path to an SQLite database where the steps completed for each
+            image and page are recorded as the upload goes. If a run is
+            interrupted, the next run with the same journal picks up where
+            it left off. The journal is cleared when a run finishes.
+        hash_index_path : string, optional, default=None
+            A path to an SQLite database that maps the content hashes of
+            the uploaded images to their names on the server, so that
+            copies of an image aren't uploaded again in later runs and
+            different images with the same file name get different names.
+            If None, this is only done within a run, see
+            default_hash_index_path for the index the command line keeps.
+        rate_limit : float, optional, default=None
+            The maximum number of requests per second sent to the server.
+            The rate is halved whenever the server says it is being sent
+            too many requests and slowly recovers afterwards. If None, the
+            requests are only slowed down by retries.
+        retries : integer, optional, default=5
+            The number of times a request that failed transiently is
+            retried, with jittered exponential backoff.
+        metrics : RunMetrics, optional, default=None
+            Where the time spent in each stage and the API calls are
+            recorded. If None, a new RunMetrics is made, see the metrics
+            attribute.
+
+        The rate limit, the retries and the counting of API calls are set up
+        on the session made here. To get them on a session passed in, mount
+        a RetryingAdapter on it and add the uploader's record_response to
+        its response hooks.
+
+        """
+
+        if user_name is None:
+            self.user_name = raw_input("What is your username?\n")
+        else:
+            self.user_name = user_name
+
+        if api_key is None:
+            self.api_key = getpass.getpass("What is your api_key?\n")
+        else:
+            self.api_key = api_key
+
+        self._owns_session = session is None
+
+        if metrics is None:
+            self.metrics = RunMetrics()
+        else:
+            self.metrics = metrics
+
+        if rate_limit is None:
+            self.rate_limiter = None
+        else:
+            self.rate_limiter = RateLimiter(rate_limit)
+        self.retries = retries
+
+        if session is None:
+            self.session = requests.Session()
+            self.session.hooks['response'].append(self.record_response)
+        else:
+            self.session = session
+
+        self.pool_size = 0
+        self.grow_connection_pool(pool_size)
+
+        self.api = slumber.API(api_url, append_slash=False,
+                               session=self.session)
+
+        self.file_index = ServerFileIndex(self.api,
+                                          cache_path=file_index_path,
+                                          max_age=file_index_max_age)
+
+        self.page_cache = PageCache(self.api)
+        self.pending_embeds = {}
+        self.page_templates = {}
+
+        self.page_keyword_prefix = "page:"
+        self.processes = 1
+        self.concurrency = 1
+        self.max_pending = None
+        self.memory_budget = None
+        self.in_memory = False
+        self.derivative_widths = []
+        self.scan_workers = 1
+        self.recursive = False
+        self.include_patterns = []
+        self.exclude_patterns = []
+        self.watched_images = {}
+        self.image_records = {}
+
+        if scan_index_path is None:
+            self.scan_index = None
+        else:
+            self.scan_index = ScanIndex(scan_index_path)
+
+        if journal_path is None:
+            self.journal = None
+        else:
+            self.journal = UploadJournal(journal_path)
+
+        self.hash_index = ContentHashIndex(hash_index_path)
+        self.upload_names = {}
+
+    def grow_connection_pool(self, pool_size):
+        """Makes sure the session made by the uploader can keep at least
+        pool_size connections to the server open, so that concurrent
+        requests reuse connections instead of opening new ones. A session
+        passed in by the user is left alone.
+
+        Parameters
+        ==========
+        pool_size : integer
+            The number of connections to keep alive.
+
+        """
+
+        if not self._owns_session or pool_size <= self.pool_size:
+            return
+
+        old_adapters = set(self.session.get_adapter(prefix) for prefix in
+                           ('http://', 'https://'))
+
+        adapter = RetryingAdapter(rate_limiter=self.rate_limiter,
+                                  retries=self.retries, metrics=self.metrics,
+                                  pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.pool_size = pool_size
+
+        # Otherwise their pooled connections stay open until exit.
+        for old_adapter in old_adapters:
+            old_adapter.close()
+
+    def record_response(self, response, *args, **kwargs):
+        """Records an API call in the metrics, this is a response hook for
+        the requests session."""
+
+        request = response.request
+        path = request.url.split('?')[0][len(self.api._store['base_url']):]
+        endpoint = path.strip('/').split('/')[0]
+
+        body = request.body
+        if body is None or not hasattr(body, '__len__'):
+            bytes_sent = 0
+        else:
+            bytes_sent = len(body)
+
+        self.metrics.record_call(request.method, endpoint,
+                                 response.status_code, bytes_sent)
+
+    def upload(self, main_keyword, *directories, **kwargs):
+        """Uploads all the new files in the specified directories with the
+        proper tags to localwiki and creates new pages if needed.
+
+        Parameters
+        ==========
+        main_keyword : string
+            The keyword embed in Iptc.Application2.Keywords that identifies
+            your image as one that belongs on your localwiki site, e.g.
+            'cleveland wiki'.
+        directories : string
+            The paths to directories to search for images.
+        page_keyword_prefix : string, optional, default="page:"
+            This is the prefix for the keyword embedded in your image which
+            contains the page name where the image belongs, e.g. if you you
+            image belongs on the front page then you keyword should look
+            like "page:Front Page".
+        processes : integer, optional, default=1
+            The number of processes used to resize and rotate images. If
+            this or concurrency is greater than one, the images are
+            prepared and uploaded in a pipeline instead of one by one.
+        concurrency : integer, optional, default=1
+            The maximum number of uploads and page requests made to the
+            server at the same time.
+        max_pending : integer, optional, default=4 * max(processes, concurrency)
+            In the pipelined mode, the maximum number of images that are
+            being prepared or are waiting to be uploaded at any time, which
+            bounds the memory used however many images there are.
+        memory_budget : integer, optional, default=None
+            In the pipelined mode, the megabytes of decoded image data each
+            process may hold on average. The processes share the total, an
+            image that doesn't fit waits until others are done, so a batch
+            of large panoramas can't exhaust the memory. If None, there is
+            no limit.
+        scan_workers : integer, optional, default=1
+            The number of threads used to read the keywords of the images
+            when scanning the directories.
+        recursive : boolean, optional, default=False
+            If true, the subdirectories of the directories are searched
+            too.
+        include : list of strings, optional, default=[]
+            Glob patterns, matched against the file name or the path
+            relative to the searched directory. If given, only the images
+            that match one of them are considered.
+        exclude : list of strings, optional, default=[]
+            Glob patterns for the files and subdirectories to skip, matched
+            in the same way.
+        in_memory : boolean, optional, default=False
+            If true, the resized and rotated images are kept in memory and
+            uploaded from there, and images that need no changes are
+            uploaded from their own files, so no temporary files are
+            written beside the photos. Either way each image is held in
+            memory in full while it is posted.
+        derivative_widths : list of integers, optional, default=[]
+            The widths of extra copies of each image, e.g. [300, 2048],
+            made from the same decode and uploaded beside it as
+            <name>-<width>w.<ext>. The embedded image then shows the
+            smallest copy that fills the thumbnail and lets the browser
+            pick a larger one with srcset.
+
+        """
+
+        self._configure(main_keyword, directories, kwargs)
+
+        start = time.time()
+
+        with self.metrics.stage('scan'):
+            wiki_images = self.find_localwiki_images()
+
+        self.upload_images(wiki_images)
+
+        self.metrics.record_stage('upload', time.time() - start)
+
+        print('Done.')
+
+    def _configure(self, main_keyword, directories, kwargs):
+        """Sets the options of upload and watch from their keyword
+        arguments."""
+
+        self.directories = list(directories)
+        self.main_keyword = main_keyword
+
+        if 'page_keyword_prefix' in kwargs.keys():
+            self.page_keyword_prefix = kwargs['page_keyword_prefix']
+        else:
+            self.page_keyword_prefix = "page:"
+
+        self.processes = kwargs.get('processes', 1)
+        self.concurrency = kwargs.get('concurrency', 1)
+        self.max_pending = kwargs.get('max_pending', None)
+        self.memory_budget = kwargs.get('memory_budget', None)
+        self.scan_workers = kwargs.get('scan_workers', 1)
+        self.recursive = kwargs.get('recursive', False)
+        self.include_patterns = kwargs.get('include', [])
+        self.exclude_patterns = kwargs.get('exclude', [])
+        self.in_memory = kwargs.get('in_memory', False)
+        self.derivative_widths = kwargs.get('derivative_widths', [])
+
+    def upload_images(self, wiki_images, upload_names=None, prepared=None,
+                      clean_up=True, page_templates=None):
+        """Uploads the images to their pages, creating the pages if
+        needed, with the options given to upload or watch.
+
+        Parameters
+        ==========
+        wiki_images : dictionary
+            Maps the paths of the images to a tuple of the names of the
+            pages they belong on and the template for new pages, as
+            returned by find_localwiki_images.
+        upload_names : dictionary, optional, default=None
+            Maps the paths of the images to a tuple of their content hash
+            and the name to upload them under. If given, the images are
+            uploaded as is, otherwise they are deduplicated first.
+        prepared : dictionary, optional, default=None
+            Maps the paths of images that were already resized and rotated
+            to the output of prepare_image, these aren't prepared again.
+        clean_up : boolean, optional, default=True
+            If false, the temporary images are left for the caller to
+            remove, e.g. when they are uploaded to another wiki too.
+        page_templates : dictionary, optional, default=None
+            Maps the page names to the template each page is created with,
+            by default the template of the first of its images that has
+            one.
+
+        """
+
+        wiki_images, remaining_uploads = self._start_upload(
+            wiki_images, upload_names=upload_names,
+            page_templates=page_templates)
+
+        self._upload_batch(wiki_images, remaining_uploads, prepared)
+
+        self._finish_upload()
+
+        if clean_up:
+            print('Cleaning up temporary images.')
+            self.remove_tmp_dirs(wiki_images.keys())
+
+    def _start_upload(self, wiki_images, upload_names=None,
+                      page_templates=None, hashes=None):
+        """Drops the images the journal shows are done, deduplicates the
+        rest unless upload_names are given and returns them with the
+        number of images to upload to each page. The images can then be
+        uploaded in one or more batches by _upload_batch, followed by
+        _finish_upload. The arguments are the same as for upload_images,
+        hashes are the content hashes for deduplicate."""
+
+        self.page_cache.clear()
+
+        if page_templates is None:
+            self.page_templates = _page_templates(wiki_images)
+        else:
+            self.page_templates = dict(page_templates)
+
+        wiki_images = dict(wiki_images)
+
+        if self.journal is not None:
+            # Don't prepare images an interrupted run already finished.
+            for file_path, (page_names, template_name) in \
+                    list(wiki_images.items()):
+                if page_names and all(
+                        self.journal.step(file_path, page_name)[0] >=
+                        UploadJournal.EMBEDDED for page_name in page_names):
+                    print("Skipping {}, the journal shows it is done.".format(file_path))
+                    del wiki_images[file_path]
+
+        if upload_names is None:
+            with self.metrics.stage('deduplicate'):
+                wiki_images = self.deduplicate(wiki_images, hashes=hashes)
+        else:
+            self.upload_names = dict(upload_names)
+
+        # The embeds for a page are applied in one patch once all of the
+        # page's images have been uploaded.
+        self.pending_embeds = {}
+        remaining_uploads = collections.Counter(
+            page_name for page_names, template_name in wiki_images.values()
+            for page_name in page_names)
+
+        return wiki_images, remaining_uploads
+
+    def _upload_batch(self, wiki_images, remaining_uploads, prepared=None):
+        """Uploads some of the images returned by _start_upload and counts
+        them off remaining_uploads, each page's embeds are applied once its
+        count reaches zero.
+
+        Parameters
+        ==========
+        wiki_images : dictionary
+            The images to upload now.
+        remaining_uploads : collections.Counter
+            The count returned by _start_upload, shared by all the
+            batches.
+        prepared : dictionary, optional, default=None
+            See upload_images.
+
+        """
+
+        processes = self.processes
+        concurrency = self.concurrency
+        if self.max_pending is None:
+            max_pending = 4 * max(processes, concurrency)
+        else:
+            max_pending = self.max_pending
+
+        if prepared is None:
+            prepared = {}
+
+        try:
+            if processes > 1 or concurrency > 1:
+                self._upload_pipelined(wiki_images, remaining_uploads,
+                                       processes, concurrency, max_pending,
+                                       prepared)
+            else:
+                self._upload_serially(wiki_images, remaining_uploads,
+                                      prepared)
+        finally:
+            # Even after a failure the cache has to list what was uploaded.
+            self.file_index.save()
+
+    def _finish_upload(self, failed=False):
+        """Applies the embeds still queued, those of pages some of whose
+        images failed to upload, and clears the journal unless failed is
+        true, so that the next run picks the failed images up."""
+
+        for page_name in sorted(self.pending_embeds.keys()):
+            self.flush_embeds(page_name)
+
+        if self.journal is not None and not failed:
+            self.journal.clear()
+
+    def _upload_serially(self, wiki_images, remaining_uploads, prepared):
+        """Prepares and uploads the images one after the other, see
+        _upload_pipelined."""
+
+        for file_path, (page_names, _) in wiki_images.items():
+
+            if file_path in prepared:
+                (tmp_file_path, aspect_ratio, caption, data, width,
+                 derivatives) = prepared[file_path]
+            else:
+                with self.metrics.stage('prepare_image'):
+                    (tmp_file_path, aspect_ratio, caption, data, width,
+                     derivatives) = self.prepare_image(
+                         file_path, in_memory=self.in_memory,
+                         metrics=self.metrics,
+                         record=self.image_records.get(file_path),
+                         derivative_widths=self.derivative_widths)
+
+            # Each file could have multple destination pages.
+            for page_name in page_names:
+                self.upload_to_page(file_path, tmp_file_path, page_name,
+                                    self.page_templates.get(page_name),
+                                    aspect_ratio, caption,
+                                    data=data, width=width,
+                                    derivatives=derivatives)
+                remaining_uploads[page_name] -= 1
+                if remaining_uploads[page_name] == 0:
+                    self.flush_embeds(page_name)
 
-    def __init__(self, api_url, user_name=None, api_key=None):
-        """Initializes the uploader.
+    def watch(self, main_keyword, *directories, **kwargs):
+        """Uploads the tagged images in the directories, then keeps
+        watching them and uploads each image as soon as it is tagged for a
+        new page, until interrupted. Only the files that changed are read
+        again, the directories aren't rescanned.
 
         Parameters
         ==========
-        api_url : string
-            This should point to your API and have a trailing slash, e.g.
-            'http://clevelandwiki.org/api/'.
-        user_name : string, optional, default=None
-            The user name for you API key. If you don't provide this here,
-            then you will be prompted to enter it on initialization.
-        api_key : string, optional, default=None
-            The api_key for this user. If you don't provide this here, then
-            you will be prompted to enter it on initialization.
+        main_keyword : string
+            The main keyword, see upload.
+        directories : string
+            The paths to the directories to watch.
+        debounce : float, optional, default=2.0
+            The number of seconds a changed file has to be left alone
+            before it is read, so that files being written or tagged are
+            read once they are complete.
+        poll_interval : float, optional, default=5.0
+            The number of seconds between checks of the directories when
+            pyinotify isn't installed.
+        use_inotify : boolean, optional, default=True
+            If false, the directories are polled even if pyinotify is
+            installed.
+
+        The other keyword arguments are the same as for upload.
 
         """
 
-        if user_name is None:
-            self.user_name = raw_input("What is your username?\n")
-        else:
-            self.user_name = user_name
+        self._configure(main_keyword, directories, kwargs)
 
-        if api_key is None:
-            self.api_key = getpass.getpass("What is your api_key?\n")
+        watcher = DirectoryWatcher(
+            self.directories, self.find_image_files, self.is_watched_file,
+            recursive=self.recursive, debounce=kwargs.get('debounce', 2.0),
+            poll_interval=kwargs.get('poll_interval', 5.0),
+            use_inotify=kwargs.get('use_inotify', True))
+
+        with self.metrics.stage('scan'):
+            self.watched_images = self.find_localwiki_images()
+
+        self.upload_images(self.watched_images)
+
+        if watcher.use_inotify:
+            print('Watching for newly tagged images.')
         else:
-            self.api_key = api_key
+            print('Polling for newly tagged images every {} seconds.'.format(watcher.poll_interval))
+
+        try:
+            for changed, removed in watcher.changes():
+                try:
+                    self.upload_changes(changed, removed)
+                except Exception as error:
+                    # Keep watching, the images are tried again when they
+                    # next change.
+                    print("Failed to upload the changed images: {}".format(error))
+        except KeyboardInterrupt:
+            print('Stopped watching.')
+        finally:
+            watcher.close()
 
-        self.api = slumber.API(api_url, append_slash=False)
+    def upload_changes(self, changed, removed=()):
+        """Reads the keywords of the images that changed and uploads those
+        that were tagged for pages they weren't tagged for before.
 
-    def upload(self, main_keyword, *directories, **kwargs):
-        """Uploads all the new files in the specified directories with the
-        proper tags to localwiki and creates new pages if needed.
+        Parameters
+        ==========
+        changed : iterable of strings
+            The paths to the images that were created or changed.
+        removed : iterable of strings, optional
+            The paths to the images that were removed.
+
+        """
+
+        for file_path in removed:
+            self.watched_images.pop(file_path, None)
+            self.image_records.pop(file_path, None)
+
+        changed = sorted(changed)
+
+        with self.metrics.stage('scan'):
+            current = self.read_localwiki_images(changed)
+
+        wiki_images = {}
+        for file_path, (page_names, template_name) in current.items():
+            previous_pages = self.watched_images.get(file_path, ([], None))[0]
+            new_pages = [page_name for page_name in page_names if page_name
+                         not in previous_pages]
+            if new_pages:
+                wiki_images[file_path] = (new_pages, template_name)
+
+        if wiki_images:
+            print("Uploading {} newly tagged images.".format(len(wiki_images)))
+            self.upload_images(wiki_images)
+
+        for file_path in changed:
+            if file_path in current:
+                self.watched_images[file_path] = current[file_path]
+            else:
+                self.watched_images.pop(file_path, None)
+
+    def plan(self, main_keyword, *directories, **kwargs):
+        """Works out what upload would do, without changing anything on the
+        server: the pages that would be created and with which templates,
+        and the images that would be uploaded, under which names, or
+        skipped. The pages and templates are looked up in batches and the
+        files on the server are listed once, so a large import takes a
+        handful of requests to plan.
 
         Parameters
         ==========
         main_keyword : string
-            The keyword embed in Iptc.Application2.Keywords that identifies
-            your image as one that belongs on your localwiki site, e.g.
-            'cleveland wiki'.
+            The main keyword, see upload.
         directories : string
-            The paths to directories to search for images.
-        page_keyword_prefix : string, optional, default="page:"
-            This is the prefix for the keyword embedded in your image which
-            contains the page name where the image belongs, e.g. if you you
-            image belongs on the front page then you keyword should look
-            like "page:Front Page".
+            The paths to the directories to search for images.
+
+        The other keyword arguments are the same as for upload.
+
+        Returns
+        =======
+        plan : dictionary
+            Can be saved as JSON and run later with execute_plan. The
+            'pages' entry maps each page name to a dictionary saying if it
+            exists, the template it would be created with and if that
+            template exists. The 'images' entry has a dictionary for each
+            image and page, with the action, 'upload' or 'skip', the reason
+            for skips, the name it would be uploaded under and its content
+            hash.
 
         """
 
-        self.directories = list(directories)
-        self.main_keyword = main_keyword
+        self._configure(main_keyword, directories, kwargs)
 
-        if 'page_keyword_prefix' in kwargs.keys():
-            self.page_keyword_prefix = kwargs['page_keyword_prefix']
-        else:
-            self.page_keyword_prefix = "page:"
+        with self.metrics.stage('scan'):
+            wiki_images = self.find_localwiki_images()
 
-        wiki_images = self.find_localwiki_images()
+        with self.metrics.stage('deduplicate'):
+            unique_images = self.deduplicate(wiki_images)
 
-        for file_path, (page_names, template_name) in wiki_images.items():
+        page_templates = _page_templates(wiki_images)
 
-            metadata = GExiv2.Metadata(file_path)
+        template_names = set(template_name for template_name in
+                             page_templates.values() if template_name)
 
-            tmp_file_path = self.create_tmp_image(file_path)
+        with self.metrics.stage('plan_pages'):
+            pages = self.page_cache.get_many(list(page_templates.keys()) +
+                                             ['Templates/' + template_name
+                                              for template_name in
+                                              template_names])
 
-            self.resize_image_to_1024(file_path, tmp_file_path)
+        if self.file_index.by_name is None:
+            self.file_index.load()
 
-            if metadata['Exif.Image.Orientation'] != '1':
-                self.rotate_image(tmp_file_path)
+        plan = {'api_url': self.api._store['base_url'],
+                'main_keyword': self.main_keyword,
+                'directories': self.directories,
+                'created': time.time(),
+                'pages': {},
+                'images': []}
 
-            aspect_ratio = float(metadata.get_pixel_width()) / \
-                float(metadata.get_pixel_height())
+        for page_name, template_name in sorted(page_templates.items()):
+            page = pages[page_name]
+            if page is not None or template_name is None:
+                template_exists = None
+            else:
+                template = pages['Templates/' + template_name]
+                template_exists = template is not None
+            plan['pages'][page_name] = {
+                'exists': page is not None,
+                'template': template_name if page is None else None,
+                'template_exists': template_exists}
+
+        for file_path in sorted(wiki_images.keys()):
+            page_names, template_name = wiki_images[file_path]
+            unique_pages = unique_images.get(file_path, ([], None))[0]
+            if file_path in self.upload_names:
+                content_hash, image_name = self.upload_names[file_path]
+            else:
+                # All of its pages have a copy already.
+                content_hash, image_name = _file_hash(file_path), None
 
-            # Each file could have multple destination pages.
             for page_name in page_names:
+                page = pages[page_name]
+                if page_name not in unique_pages:
+                    action, reason = 'skip', 'duplicate'
+                elif (page is not None and
+                        self.file_exists_on_server(image_name, page['slug'])):
+                    action, reason = 'skip', 'exists'
+                else:
+                    action, reason = 'upload', None
+                plan['images'].append({'path': file_path,
+                                       'page': page_name,
+                                       'template': template_name,
+                                       'name': image_name,
+                                       'hash': content_hash,
+                                       'action': action,
+                                       'reason': reason})
 
-                page = self.create_page(page_name, template_name)
-                image_name = os.path.split(file_path)[1]
+        return plan
 
-                # TODO : This check should be "if file exists on a page",
-                # as it stands this probably wouldn't allow uploads to
-                # multiple pages.
-                if not self.file_exists_on_server(image_name):
+    def execute_plan(self, plan, **kwargs):
+        """Uploads the images a plan says to upload, under the names it
+        gives them. Images that changed since the plan was made are
+        skipped.
 
-                    self.upload_image(page, tmp_file_path)
+        Parameters
+        ==========
+        plan : dictionary
+            A plan made by plan.
+
+        The keyword arguments are the same as for upload.
+
+        """
+
+        if plan['api_url'] != self.api._store['base_url']:
+            raise ValueError("The plan was made for {}, not {}.".format(
+                plan['api_url'], self.api._store['base_url']))
+
+        self._configure(plan['main_keyword'], plan['directories'], kwargs)
+
+        start = time.time()
+
+        wiki_images = {}
+        upload_names = {}
+        changed = set()
+
+        for image in plan['images']:
+            file_path = image['path']
+            if image['action'] != 'upload' or file_path in changed:
+                continue
+            if file_path not in upload_names:
+                if (not os.path.exists(file_path) or
+                        _file_hash(file_path) != image['hash']):
+                    print("Skipping {}, it changed since the plan was made.".format(file_path))
+                    changed.add(file_path)
+                    continue
+                upload_names[file_path] = (image['hash'], image['name'])
+            page_names = wiki_images.setdefault(
+                file_path, ([], image['template']))[0]
+            page_names.append(image['page'])
+
+        page_templates = dict((page_name, page['template']) for
+                              page_name, page in plan['pages'].items())
+
+        self.upload_images(wiki_images, upload_names=upload_names,
+                           page_templates=page_templates)
+
+        self.metrics.record_stage('upload', time.time() - start)
+
+        print('Done.')
+
+    def _upload_pipelined(self, wiki_images, remaining_uploads, processes,
+                          concurrency, max_pending, prepared=None):
+        """Prepares the images in a process pool and uploads them from a
+        thread pool as soon as each one is ready. The uploads to any one
+        page happen one at a time and in order, so the embeds don't race
+        on the page's content.
+
+        Parameters
+        ==========
+        wiki_images : dictionary
+            The output of find_localwiki_images.
+        remaining_uploads : collections.Counter
+            The number of images to upload to each page, the page's embeds
+            are applied after its last upload.
+        processes : integer
+            The number of processes used to resize and rotate the images.
+        concurrency : integer
+            The maximum number of uploads and page requests in flight.
+        max_pending : integer
+            The maximum number of images that are being prepared or are
+            waiting to be uploaded. Images are only handed to the process
+            pool as earlier ones finish uploading, so a slow connection
+            doesn't pile up prepared images in memory.
+        prepared : dictionary, optional, default=None
+            The images that were already prepared, see upload_images. The
+            process pool is only started if some image isn't.
+
+        """
+
+        if prepared is None:
+            prepared = {}
+
+        # Fetch the file listing before the threads start sharing it.
+        if self.file_index.by_name is None:
+            self.file_index.load()
+
+        self.grow_connection_pool(concurrency)
+
+        process_pool = None
+        thread_pool = ThreadPool(concurrency)
+        serializer = PageSerializer(thread_pool)
+
+        file_paths = sorted(wiki_images.keys())
+
+        slots = threading.Semaphore(max_pending)
+        lock = threading.Lock()
+        pages_left = dict((path, len(wiki_images[path][0])) for path in
+                          file_paths)
+
+        def release(file_path):
+            """Frees the image's slot once it is on all of its pages."""
+            with lock:
+                pages_left[file_path] -= 1
+                done = pages_left[file_path] <= 0
+            if done:
+                slots.release()
+
+        def upload_to_page(file_path, *args):
+            try:
+                self.upload_to_page(file_path, *args)
+            finally:
+                release(file_path)
+
+        def submit(file_path, result):
+            """Waits for the image to be prepared and queues its uploads."""
+            prepared, stages = result.get()
+            (tmp_file_path, aspect_ratio, caption, data, width,
+             derivatives) = prepared
+            self.metrics.merge_stages(stages)
+            page_names = wiki_images[file_path][0]
+            if not page_names:
+                release(file_path)
+            for page_name in page_names:
+                serializer.submit(page_name, upload_to_page, file_path,
+                                  tmp_file_path, page_name,
+                                  self.page_templates.get(page_name),
+                                  aspect_ratio, caption, data, width,
+                                  derivatives)
+                remaining_uploads[page_name] -= 1
+                if remaining_uploads[page_name] == 0:
+                    serializer.submit(page_name, self.flush_embeds,
+                                      page_name)
+
+        # The prepared images are queued for upload in order.
+        preparing = collections.deque()
 
-                    if 'Iptc.Application2.Caption' in metadata.get_iptc_tags():
-                        self.embed_image(page_name, image_name, aspect_ratio,
-                            caption=metadata['Iptc.Application2.Caption'])
+        try:
+            for file_path in file_paths:
+                # Images that are prepared but not queued hold slots too, so
+                # queue them while waiting for a free slot.
+                while not slots.acquire(False):
+                    if preparing:
+                        submit(*preparing.popleft())
                     else:
-                        self.embed_image(page_name, image_name, aspect_ratio)
+                        slots.acquire()
+                        break
+                if file_path in prepared:
+                    result = _PreparedResult((prepared[file_path], {}))
                 else:
-                    print("Skipping {}, it already exists on the localwiki.".format(file_path))
+                    if process_pool is None:
+                        process_pool = self._start_process_pool(processes)
+                    result = process_pool.apply_async(
+                        _prepare_image, ((file_path, self.in_memory,
+                                          self.image_records.get(file_path),
+                                          self.derivative_widths),))
+                preparing.append((file_path, result))
+                while preparing and preparing[0][1].ready():
+                    submit(*preparing.popleft())
+            while preparing:
+                submit(*preparing.popleft())
+            serializer.join()
+        finally:
+            if process_pool is not None:
+                process_pool.close()
+            thread_pool.close()
+            if process_pool is not None:
+                process_pool.join()
+            thread_pool.join()
 
-        print('Cleaning up temporary images.')
-        self.remove_tmp_dirs(wiki_images.keys())
-        print('Done.')
+    def _start_process_pool(self, processes):
+        """Returns a pool of processes that prepare images, sharing the
+        memory budget if there is one."""
+
+        if self.memory_budget is None:
+            decode_budget = None
+        else:
+            decode_budget = DecodeBudget(self.memory_budget * processes)
+
+        return multiprocessing.Pool(processes, initializer=_init_worker,
+                                    initargs=(decode_budget,))
+
+    @classmethod
+    def prepare_image(cls, file_path, in_memory=False, metrics=None,
+                      decode_budget=None, record=None, derivative_widths=()):
+        """Makes a resized and rotated temporary copy of the image ready
+        for upload, and copies of the derivative widths.
+
+        Parameters
+        ==========
+        file_path : string
+            The path to the original image file.
+        in_memory : boolean, optional, default=False
+            If true, the processed image is kept in memory instead of
+            being written to a temporary file, and images that need no
+            processing are uploaded from the original file, without a
+            copy.
+        metrics : RunMetrics, optional, default=None
+            If given, the time spent reading the metadata and processing
+            the image is recorded in it.
+        decode_budget : DecodeBudget, optional, default=None
+            If given, the image waits for room in the budget before it is
+            decoded.
+        record : ImageRecord, optional, default=None
+            The metadata of the image read when it was scanned. If None,
+            it is read here.
+        derivative_widths : list of integers, optional, default=()
+            The widths of the extra copies uploaded beside the image, see
+            encode_images. They are made from the same decode.
+
+        Returns
+        =======
+        tmp_file_path : string
+            The path to the temporary image copy, or to the original file
+            if in_memory is true or the image needs no processing.
+        aspect_ratio : float
+            The ratio of width to height of the original image.
+        caption : string or None
+            The IPTC caption of the image, if it has one.
+        data : bytes or None
+            The contents of the processed image if in_memory is true and
+            the image needed processing, otherwise None.
+        width : integer
+            The width of the uploaded image as displayed.
+        derivatives : list of tuples
+            The (derivative width, width as displayed, path, data) of each
+            derivative that was made, where the path and data are as for
+            the image. Derivatives that would be no smaller than the
+            original or the same size as the image are left out.
+
+        """
+
+        if metrics is None:
+            metrics = RunMetrics()
+
+        if record is None:
+            with metrics.stage('read_metadata'):
+                record = _read_image_record(file_path)
+
+        derivatives = []
+
+        if not derivative_widths and not cls.needs_processing(record):
+            # Upload the original untouched.
+            tmp_file_path = file_path
+            data = None
+            width = record.width
+        else:
+            with metrics.stage('process_image'):
+                images = cls.encode_images(file_path,
+                                           widths=derivative_widths,
+                                           decode_budget=decode_budget)
+
+            data, size = images[0]
+            width = size[0]
+            if data is None or in_memory:
+                tmp_file_path = file_path
+            else:
+                tmp_file_path = cls.tmp_image_path(file_path)
+                with open(tmp_file_path, 'wb') as f:
+                    f.write(data)
+                data = None
+
+            for derivative_width, image in zip(derivative_widths,
+                                               images[1:]):
+                if image is None:
+                    continue
+                derivative_data, size = image
+                if in_memory:
+                    derivative_path = file_path
+                else:
+                    derivative_path = cls.tmp_image_path(file_path,
+                                                         derivative_width)
+                    with open(derivative_path, 'wb') as f:
+                        f.write(derivative_data)
+                    derivative_data = None
+                derivatives.append((derivative_width, size[0],
+                                    derivative_path, derivative_data))
+
+        aspect_ratio = float(record.width) / float(record.height)
+
+        return (tmp_file_path, aspect_ratio, record.caption, data, width,
+                derivatives)
+
+    @classmethod
+    def needs_processing(cls, metadata):
+        """Returns true if the image has to be resized or rotated before it
+        is uploaded, judging only from its header.
+
+        Parameters
+        ==========
+        metadata : ImageRecord or GExiv2.Metadata
+            The metadata of the original image file.
+
+        """
+
+        if not isinstance(metadata, ImageRecord):
+            metadata = ImageRecord.from_metadata(metadata)
+
+        return (metadata.width > cls._max_width or
+                metadata.orientation != '1')
+
+    def upload_to_page(self, file_path, tmp_file_path, page_name,
+                       template_name, aspect_ratio, caption=None, data=None,
+                       width=None, derivatives=()):
+        """Creates the page if needed, then uploads the prepared image to
+        it and queues it to be embedded in the page by flush_embeds. A
+        file that is already on the page isn't uploaded again, but it is
+        still embedded if the page doesn't show it yet.
+
+        Parameters
+        ==========
+        file_path : string
+            The path to the original image file.
+        tmp_file_path : string
+            The path to the prepared image file.
+        page_name : string
+            The name of the page the image belongs on.
+        template_name : string or None
+            The template used if the page has to be created.
+        aspect_ratio : float
+            The ratio of width to height of the original image.
+        caption : string, optional, default=None
+            The caption for the embedded image.
+        data : bytes, optional, default=None
+            The contents of the prepared image, if it is held in memory.
+        width : integer, optional, default=None
+            The width of the prepared image as displayed, needed if there
+            are derivatives.
+        derivatives : list of tuples, optional, default=()
+            The derivatives made by prepare_image, they are uploaded after
+            the image and listed in the srcset of its embed.
+
+        """
+
+        content_hash, image_name = self.upload_names.get(
+            file_path, (None, os.path.split(file_path)[1]))
+
+        if derivatives:
+            variants = [(self.derivative_name(image_name, derivative[0]),
+                         derivative[1]) for derivative in derivatives]
+            variants.append((image_name, width))
+        else:
+            variants = []
+
+        if caption is None:
+            caption = self._default_caption
+
+        if self.journal is None:
+            step, slug = UploadJournal.NOT_STARTED, None
+        else:
+            step, slug = self.journal.step(file_path, page_name)
+
+        if step >= UploadJournal.EMBEDDED:
+            print("Skipping {}, the journal shows it is done.".format(file_path))
+        elif step >= UploadJournal.UPLOADED:
+            # Resume an interrupted run that uploaded but didn't embed.
+            self.pending_embeds.setdefault(page_name, []).append(
+                (file_path, image_name, aspect_ratio, caption, variants))
+        else:
+            if step >= UploadJournal.PAGE_CREATED:
+                page = {'name': page_name, 'slug': slug}
+            else:
+                page = self.create_page(page_name, template_name)
+                self._record_step(file_path, page_name,
+                                  UploadJournal.PAGE_CREATED, page['slug'])
+
+            # Only the page's own files count, so an image that is tagged
+            # for another page later is uploaded there too.
+            if not self.file_exists_on_server(image_name, page['slug']):
+
+                self.upload_image(page, tmp_file_path, data=data,
+                                  file_name=image_name)
+
+                for (derivative_width, _, derivative_path,
+                     derivative_data) in derivatives:
+                    derivative_name = self.derivative_name(image_name,
+                                                           derivative_width)
+                    if not self.file_exists_on_server(derivative_name,
+                                                      page['slug']):
+                        self.upload_image(page, derivative_path,
+                                          data=derivative_data,
+                                          file_name=derivative_name)
+
+                self._record_step(file_path, page_name,
+                                  UploadJournal.UPLOADED, page['slug'])
+
+                self.pending_embeds.setdefault(page_name, []).append(
+                    (file_path, image_name, aspect_ratio, caption, variants))
+            elif ('_files/' + image_name not in
+                  self.page_cache.get(page_name)['content']):
+                # A run that stopped between the upload and the embed.
+                print("{} is already on the localwiki, embedding it.".format(file_path))
+                existing_variants = [
+                    variant for variant in variants[:-1] if
+                    self.file_exists_on_server(variant[0], page['slug'])]
+                if existing_variants:
+                    existing_variants.append(variants[-1])
+                self.pending_embeds.setdefault(page_name, []).append(
+                    (file_path, image_name, aspect_ratio, caption,
+                     existing_variants))
+            else:
+                print("Skipping {}, it already exists on the localwiki.".format(file_path))
+                self._record_step(file_path, page_name,
+                                  UploadJournal.EMBEDDED, page['slug'])
+                # A file someone else put there may be a different image
+                # with the same name.
+                if (content_hash is not None and
+                        self.hash_index.was_posted(page['slug'],
+                                                   image_name)):
+                    self.hash_index.record(content_hash, page_name,
+                                           image_name)
+
+    def deduplicate(self, wiki_images, hashes=None):
+        """Drops the pages that already have a copy of the image, from
+        this run or, if the hash index is kept on disk, an earlier one,
+        and picks the name each remaining image is uploaded under. Images
+        left with no pages are dropped before they are prepared. With a
+        scan index, only the files that changed since they were last
+        hashed are read.
+
+        Parameters
+        ==========
+        wiki_images : dictionary
+            The output of find_localwiki_images.
+        hashes : dictionary, optional, default=None
+            The output of content_hashes for the images, if they have
+            been hashed already.
+
+        Returns
+        =======
+        wiki_images : dictionary
+            The images and pages that still need uploading.
+
+        """
+
+        if hashes is None:
+            hashes = self.content_hashes(wiki_images.keys())
+
+        self.upload_names = {}
+        self.hash_index.clear_claims()
+        claimed = set()
+        unique_images = {}
+
+        for file_path in sorted(wiki_images.keys()):
+            page_names, template_name = wiki_images[file_path]
+            content_hash = hashes[file_path]
+
+            new_page_names = []
+            for page_name in page_names:
+                if ((content_hash, page_name) in claimed or
+                        self.hash_index.lookup(content_hash, page_name)
+                        is not None):
+                    print("Skipping {}, a copy of it is already on {}.".format(file_path, page_name))
+                else:
+                    claimed.add((content_hash, page_name))
+                    new_page_names.append(page_name)
+
+            if new_page_names or not page_names:
+                unique_images[file_path] = (new_page_names, template_name)
+                self.upload_names[file_path] = \
+                    (content_hash, self.upload_name(file_path, content_hash))
+
+        return unique_images
+
+    def content_hashes(self, file_paths):
+        """Returns a dictionary mapping the paths of the image files to
+        their content hashes. With a scan index, only the files that
+        changed since they were last hashed are read.
+
+        Parameters
+        ==========
+        file_paths : iterable of strings
+            The paths to the image files.
+
+        """
+
+        if self.scan_index is None:
+            return dict((file_path, _file_hash(file_path)) for file_path in
+                        file_paths)
+
+        hashes = dict((file_path, self.scan_index.content_hash(file_path))
+                      for file_path in file_paths)
+        self.scan_index.commit()
+
+        return hashes
+
+    def upload_name(self, file_path, content_hash):
+        """Returns the name to upload the image under. This is the file's
+        name, unless a different image has been uploaded or claimed under
+        that name, in which case the start of the content hash is added to
+        it. Files on the server that aren't in the hash index are assumed
+        to be the same image, as they were uploaded before hashing.
+
+        Parameters
+        ==========
+        file_path : string
+            The path to the original image file.
+        content_hash : string
+            The content hash of the original image file.
+
+        """
+
+        file_name = os.path.split(file_path)[1]
+
+        hashes = self.hash_index.hashes_for_name(file_name)
+        if hashes and content_hash not in hashes:
+            root, ext = os.path.splitext(file_name)
+            file_name = '{}-{}{}'.format(root, content_hash[:8], ext)
+
+        self.hash_index.claim(content_hash, file_name)
+
+        return file_name
+
+    def flush_embeds(self, page_name):
+        """Embeds all the images queued for the page in a single patch.
+
+        Parameters
+        ==========
+        page_name : string
+            The name of the page.
+
+        """
+
+        images = self.pending_embeds.pop(page_name, [])
+
+        if images:
+            self.embed_images(page_name, [image[1:] for image in images])
+            slug = self.page_cache.get(page_name)['slug']
+            for image in images:
+                self._record_step(image[0], page_name,
+                                  UploadJournal.EMBEDDED, slug)
+                # The copy only counts once it is embedded, so that a run
+                # that stops before this embeds it the next time, and only
+                # if it was posted by the uploader, see upload_to_page.
+                content_hash = self.upload_names.get(image[0],
+                                                     (None, None))[0]
+                if (content_hash is not None and
+                        self.hash_index.was_posted(slug, image[1])):
+                    self.hash_index.record(content_hash, page_name,
+                                           image[1])
+
+    def _record_step(self, file_path, page_name, step, slug):
+        """Records the step in the journal, if there is one."""
+
+        if self.journal is not None:
+            self.journal.record(file_path, page_name, step, slug)
 
     def remove_tmp_dirs(self, file_paths):
         """Removes any of the temporary directories used to rotate images.
@@ -138,62 +2901,267 @@ class ImageUploader(object):
         names for all images in the provided directories that have the
         correct tags."""
 
-        wiki_images = {}
+        file_paths = itertools.chain.from_iterable(
+            self.find_image_files(directory) for directory in
+            self.directories)
+
+        return self.read_localwiki_images(file_paths)
+
+    def find_localwiki_images_in_directory(self, directory):
+        """Returns a dictionary mapping local image paths of files in the
+        given directory to a tuple with the local wiki page names and an
+        optional template.
+
+        Parameters
+        ==========
+        directory : string
+            The path to the directory that should be scanned for localwiki
+            images.
+
+        Returns
+        =======
+        wiki_images : dictionary
+            The key is the path to the images which have the main keyword
+            and the associated value is a tuple of a list of localwiki page
+            names this image should be associated with and a template to use
+            for the page creation.
+
+        """
+
+        return self.read_localwiki_images(self.find_image_files(directory))
+
+    def find_image_files(self, directory):
+        """Yields the paths to the image files in the directory as they are
+        found. If recursive is set, the subdirectories are searched too,
+        following symbolic links but never entering the same directory
+        twice, and skipping those that can't be read. The temporary
+        directories are always skipped.
+
+        Parameters
+        ==========
+        directory : string
+            The path to the directory.
+
+        """
+
+        extensions = tuple(self._file_extensions)
+        visited = set()
+        directories = [directory]
+
+        while directories:
+            current = directories.pop()
+
+            real_path = os.path.realpath(current)
+            if real_path in visited:
+                continue
+            visited.add(real_path)
+
+            subdirectories = []
+
+            try:
+                entries = list(scandir(current))
+            except OSError as error:
+                if current == directory:
+                    raise
+                # E.g. a directory without read permission, or one that
+                # was removed while the scan ran.
+                print("Skipping {}, it can't be read: {}".format(current, error))
+                continue
+
+            for entry in entries:
+                relative_path = os.path.relpath(entry.path, directory)
+                if self._matches(self.exclude_patterns, entry.name,
+                                 relative_path):
+                    continue
+                if entry.is_dir():
+                    if self.recursive and entry.name != self._tmp_dir_name:
+                        subdirectories.append(entry.path)
+                elif (entry.name.endswith(extensions) and
+                      (not self.include_patterns or
+                       self._matches(self.include_patterns, entry.name,
+                                     relative_path))):
+                    yield entry.path
+
+            # Visit the subdirectories in order, depth first.
+            directories.extend(sorted(subdirectories, reverse=True))
+
+    def is_watched_file(self, file_path):
+        """Returns true if the path is an image file that find_image_files
+        would find in one of the directories, without touching the file.
+
+        Parameters
+        ==========
+        file_path : string
+            The path to the file.
+
+        """
+
         for directory in self.directories:
-            wiki_images.update(self.find_localwiki_images_in_directory(directory))
+            relative_path = os.path.relpath(file_path, directory)
+            parts = relative_path.split(os.sep)
+
+            if parts[0] == os.pardir:
+                continue
+            if len(parts) > 1 and (not self.recursive or
+                                   self._tmp_dir_name in parts[:-1]):
+                continue
+            if not parts[-1].endswith(tuple(self._file_extensions)):
+                continue
+            # An excluded directory excludes everything in it.
+            if any(self._matches(self.exclude_patterns, name,
+                                 os.path.join(*parts[:i + 1])) for i, name
+                   in enumerate(parts)):
+                continue
+            if (not self.include_patterns or
+                    self._matches(self.include_patterns, parts[-1],
+                                  relative_path)):
+                return True
+
+        return False
+
+    @staticmethod
+    def _matches(patterns, name, relative_path):
+        """Returns true if the name or the relative path matches any of the
+        glob patterns."""
 
-        return wiki_images
+        for pattern in patterns:
+            if (fnmatch.fnmatch(name, pattern) or
+                    fnmatch.fnmatch(relative_path, pattern)):
+                return True
 
-    def find_localwiki_images_in_directory(self, directory):
-        """Returns a dictionary mapping local image paths of files in the
-        given directory to a tuple with the local wiki page names and an
-        optional template.
+        return False
+
+    def read_localwiki_images(self, file_paths):
+        """Reads the metadata of each of the image files and returns the
+        ones that have the main keyword, using scan_workers threads. If
+        there is a scan index, only the files that are new or have changed
+        since they were last read are opened. The paths are consumed a
+        chunk at a time, so they can be a generator over a very large
+        tree. The ImageRecord of each image returned is kept in
+        image_records for the later stages.
 
         Parameters
         ==========
-        directory : string
-            The path to the directory that should be scanned for localwiki
-            images.
+        file_paths : iterable of strings
+            The paths to the image files.
 
         Returns
         =======
         wiki_images : dictionary
-            The key is the path to the images which have the main keyword
-            and the associated value is a tuple of a list of localwiki page
-            names this image should be associated with and a template to use
-            for the page creation.
+            The same mapping as find_localwiki_images_in_directory.
 
         """
 
-        file_names = os.listdir(directory)
+        if self.scan_workers > 1:
+            pool = ThreadPool(self.scan_workers)
+        else:
+            pool = None
 
         wiki_images = {}
 
-        for file_name in file_names:
+        try:
+            for chunk in _chunks(file_paths, self._scan_chunk_size):
+                records = self._read_chunk_records(chunk, pool)
+                for file_path in chunk:
 
-            if True in [file_name.endswith(ext) for ext in
-                        self._file_extensions]:
-                metadata = GExiv2.Metadata(os.path.join(directory, file_name))
-                keywords = \
-                    metadata.get_tag_multiple('Iptc.Application2.Keywords')
+                    record = records[file_path]
 
-                # TODO : What happens if the image only has the
-                # main_keyword and the page list is empty?
+                    # TODO : What happens if the image only has the
+                    # main_keyword and the page list is empty?
 
-                if self.main_keyword in keywords:
+                    if self.main_keyword in record.keywords:
+                        page_names = self.parse_keywords(
+                            record.keywords, self.page_keyword_prefix)[0]
+                        wiki_images[file_path] = (page_names,
+                                                  record.template)
+                        self.image_records[file_path] = record
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
 
-                    try:
-                        template = [keyword.split(':')[1] for keyword in
-                                    keywords if
-                                    keyword.startswith('template:')][0]
-                    except IndexError:
-                        template = None
+        return wiki_images
 
-                    wiki_images[os.path.join(directory, file_name)] = \
-                        ([keyword.split(':')[1] for keyword in keywords if
-                            keyword.startswith('page:')], template)
+    def _read_chunk_records(self, file_paths, pool=None):
+        """Returns a dictionary mapping each of the paths to the
+        ImageRecord of the file, from the scan index where possible.
 
-        return wiki_images
+        Parameters
+        ==========
+        file_paths : list of strings
+            The paths to the image files.
+        pool : multiprocessing.pool.ThreadPool, optional, default=None
+            The pool to read the files with, if None they are read one
+            after the other.
+
+        """
+
+        if self.scan_index is None:
+            known = {}
+            unknown = dict((path, None) for path in file_paths)
+        else:
+            known, unknown = self.scan_index.partition(file_paths,
+                                                       self.main_keyword)
+
+        unknown_paths = [path for path in file_paths if path in unknown]
+
+        # Files whose headers show they can't have the main keyword aren't
+        # read in full.
+        args = [(path, self.main_keyword) for path in unknown_paths]
+        if pool is not None:
+            records = pool.map(_read_tagged_image_record, args)
+        else:
+            records = [_read_tagged_image_record(arg) for arg in args]
+
+        untagged = ImageRecord([], [], None, None, None, None, None)
+
+        for file_path, record in zip(unknown_paths, records):
+            if record is None:
+                known[file_path] = untagged
+                # Only a scan for the same keyword may skip these.
+                if self.scan_index is not None:
+                    mtime, size = unknown[file_path]
+                    self.scan_index.store_untagged(file_path, mtime, size,
+                                                   self.main_keyword)
+            else:
+                known[file_path] = record
+                if self.scan_index is not None:
+                    mtime, size = unknown[file_path]
+                    self.scan_index.store(file_path, mtime, size, record)
+
+        if self.scan_index is not None:
+            self.scan_index.commit()
+
+        return known
+
+    @staticmethod
+    def parse_keywords(keywords, page_keyword_prefix="page:"):
+        """Returns the page names and the template named in the keywords.
+
+        Parameters
+        ==========
+        keywords : list of strings
+            The keywords of an image.
+        page_keyword_prefix : string, optional, default="page:"
+            The prefix of the keywords that name pages.
+
+        Returns
+        =======
+        page_names : list of strings
+            The names of the pages the image belongs on.
+        template : string or None
+            The template to use when creating the pages.
+
+        """
+
+        try:
+            template = [keyword.split(':')[1] for keyword in keywords if
+                        keyword.startswith('template:')][0]
+        except IndexError:
+            template = None
+
+        return ([keyword[len(page_keyword_prefix):] for keyword in keywords
+                 if keyword.startswith(page_keyword_prefix)], template)
 
     def create_page(self, page_name, template_name=None):
         """Creates a new blank page on the server with the provided page
@@ -214,34 +3182,44 @@ class ImageUploader(object):
 
         """
 
-        page_dict = {
-            "content": self._stub_page_content,
-            "name": page_name,
-        }
+        with self.metrics.stage('create_page'):
+            page_dict = {
+                "content": self._stub_page_content,
+                "name": page_name,
+            }
 
-        try:
-            return self.api.page(page_name).get()
-        except slumber.exceptions.HttpClientError:
+            try:
+                return self.page_cache.get(page_name)
+            except slumber.exceptions.HttpClientError as error:
 
-            note_addition = ' with default content'
+                if not _is_not_found(error):
+                    raise
 
-            if template_name is not None:
-                try:
-                    template_dict = self.api.page('Templates/' +
-                                                  template_name).get()
-                except slumber.exceptions.HttpClientError:
-                    print("There is no template named {}, using default.".format(template_name))
-                else:
-                    page_dict['content'] = template_dict['content']
-                    note_addition = " with template {}".format(template_name)
+                note_addition = ' with default content'
+
+                if template_name is not None:
+                    try:
+                        template_dict = self.page_cache.get('Templates/' +
+                                                            template_name)
+                    except slumber.exceptions.HttpClientError as error:
+                        if not _is_not_found(error):
+                            raise
+                        print("There is no template named {}, using default.".format(template_name))
+                    else:
+                        page_dict['content'] = template_dict['content']
+                        note_addition = " with template {}".format(template_name)
 
-            print("Creating the new page: {}{}.".format(page_name,
-                                                        note_addition))
+                print("Creating the new page: {}{}.".format(page_name,
+                                                            note_addition))
 
-            self.api.page.post(page_dict, username=self.user_name,
-                               api_key=self.api_key)
+                response = self.api.page.post(page_dict,
+                                              username=self.user_name,
+                                              api_key=self.api_key)
 
-            return self.api.page(page_name).get()
+                page = self.page_cache.update(page_name, response)
+                self.hash_index.record_created(page['slug'])
+
+                return page
 
     def find_files_in_page(self, page_name):
         """Returns a list of dictionaries, one for each file, attached to a
@@ -260,33 +3238,68 @@ class ImageUploader(object):
 
         """
         try:
-            slug = self.api.page(page_name).get()['slug']
-        except slumber.exceptions.HttpClientError:
+            slug = self.page_cache.get(page_name)['slug']
+        except slumber.exceptions.HttpClientError as error:
+            if not _is_not_found(error):
+                raise
             return None
         else:
             return self.api.file.get(slug=slug)['objects']
 
-    def file_exists_on_server(self, file_name):
+    def file_exists_on_server(self, file_name, slug=None):
         """Returns true if the file already exists on the server.
 
         Parameters
         ==========
         file_name : string
             The name of the file, as stored in localwiki.
+        slug : string, optional, default=None
+            If given, only files attached to the page with this slug are
+            considered.
+
+        """
+
+        return self.file_index.exists(file_name, slug=slug)
 
+    @classmethod
+    def tmp_image_path(cls, file_path, derivative_width=None):
+        """Returns the path of the temporary copy of the file in a tmp
+        directory beside the file, creating the directory if needed.
+
+        Parameters
+        ==========
+        file_path : string
+            The path to the image file.
+        derivative_width : integer, optional, default=None
+            If given, the path of the derivative of this width.
 
         """
 
-        file_list = self.api.file.get(limit=0)['objects']
+        directory, file_name = os.path.split(file_path)
+        if derivative_width is not None:
+            file_name = cls.derivative_name(file_name, derivative_width)
+        tmp_directory = os.path.join(directory, cls._tmp_dir_name)
+
+        try:
+            os.mkdir(tmp_directory)
+        except OSError:
+            # It may have been made by another worker in the meantime.
+            if not os.path.isdir(tmp_directory):
+                raise
+
+        return os.path.join(tmp_directory, file_name)
+
+    @staticmethod
+    def derivative_name(file_name, derivative_width):
+        """Returns the name of the derivative of the given width of an
+        image, e.g. photo-300w.jpg for photo.jpg."""
 
-        exists = False
-        for file_dict in file_list:
-            if file_dict['name'] == file_name:
-                exists = True
+        root, ext = os.path.splitext(file_name)
 
-        return exists
+        return '{}-{}w{}'.format(root, derivative_width, ext)
 
-    def create_tmp_image(self, file_path):
+    @classmethod
+    def create_tmp_image(cls, file_path):
         """Makes a copy of the file in a tmp directory beside the file.
 
         Parameters
@@ -301,19 +3314,226 @@ class ImageUploader(object):
 
         """
 
-        directory, file_name = os.path.split(file_path)
-        tmp_directory = os.path.join(directory, self._tmp_dir_name)
-        tmp_file_path = os.path.join(tmp_directory, file_name)
-
-        if not os.path.isdir(tmp_directory):
-            os.mkdir(tmp_directory)
+        tmp_file_path = cls.tmp_image_path(file_path)
 
         shutil.copyfile(file_path, tmp_file_path)
 
         return tmp_file_path
 
-    @staticmethod
-    def rotate_image(file_path):
+    @classmethod
+    def normalize_image(cls, source_path, destination_path, max_width=1024,
+                        rotate=True, decode_budget=None):
+        """Writes an upright copy of the image that is at most max_width
+        wide, see encode_image. If nothing needs to change, the file is
+        just copied.
+
+        Parameters
+        ==========
+        source_path : string
+            The path to the original image file.
+        destination_path : string
+            The path to write the normalized image to, this can be the same
+            as the source path.
+        max_width : integer or None, optional, default=1024
+            The maximum width of the image, as stored before it is rotated.
+            If None, the image isn't resized.
+        rotate : boolean, optional, default=True
+            If true, the image is rotated upright.
+        decode_budget : DecodeBudget, optional, default=None
+            The budget the decoded image is held in, see encode_image.
+
+        Returns
+        =======
+        size : tuple of integers
+            The width and height of the normalized image.
+
+        """
+
+        data, size = cls.encode_image(source_path, max_width=max_width,
+                                      rotate=rotate,
+                                      decode_budget=decode_budget)
+
+        if data is None:
+            if source_path != destination_path:
+                shutil.copyfile(source_path, destination_path)
+        else:
+            with open(destination_path, 'wb') as f:
+                f.write(data)
+
+        return size
+
+    @classmethod
+    def encode_image(cls, source_path, max_width=1024, rotate=True,
+                     decode_budget=None):
+        """Returns the contents of an upright copy of the image that is at
+        most max_width wide. The image is decoded once, transposed
+        according to its Exif orientation, shrunk and encoded once, and the
+        Exif, IPTC and XMP metadata of JPEGs are carried over with the
+        orientation and pixel dimensions updated. JPEGs that are shrunk
+        are decoded at a reduced scale, no less than twice the final size,
+        so very large photos never take their full size in memory.
+
+        Parameters
+        ==========
+        source_path : string
+            The path to the original image file.
+        max_width : integer or None, optional, default=1024
+            The maximum width of the image, as stored before it is rotated.
+            If None, the image isn't resized.
+        rotate : boolean, optional, default=True
+            If true, the image is rotated upright.
+        decode_budget : DecodeBudget, optional, default=None
+            If given, the estimated size of the decoded image is reserved
+            in it until the image is encoded.
+
+        Returns
+        =======
+        data : bytes or None
+            The encoded image, or None if the image doesn't need to change.
+        size : tuple of integers
+            The width and height of the encoded image.
+
+        """
+        return cls.encode_images(source_path, max_width=max_width,
+                                 rotate=rotate,
+                                 decode_budget=decode_budget)[0]
+
+    @classmethod
+    def encode_images(cls, source_path, max_width=1024, widths=(),
+                      rotate=True, decode_budget=None):
+        """Returns the contents of the upright copy of the image made by
+        encode_image and of smaller or larger derivatives of it, all from
+        a single decode. The copies are made from largest to smallest, each
+        one shrunk from the one before, and the decode is at a reduced
+        scale when even the largest copy is shrunk.
+
+        Parameters
+        ==========
+        source_path : string
+            The path to the original image file.
+        max_width : integer or None, optional, default=1024
+            The maximum width of the main copy, see encode_image.
+        widths : list of integers, optional, default=()
+            The widths of the derivatives, as displayed after rotation.
+        rotate : boolean, optional, default=True
+            If true, the images are rotated upright.
+        decode_budget : DecodeBudget, optional, default=None
+            See encode_image.
+
+        Returns
+        =======
+        images : list of tuples
+            The (data, size) of the main copy, as returned by encode_image,
+            followed by the (data, size) of each derivative, or None for
+            the derivatives that would be as large as the main copy or the
+            original.
+
+        """
+
+        with open(source_path, 'rb') as f:
+            segments = _read_jpeg_segments(f)
+            f.seek(0)
+            img = Image.open(f)
+            img_format = img.format
+            exif = img.info.get('exif')
+            icc_profile = img.info.get('icc_profile')
+
+            width, height = img.size
+            aspect_ratio = float(width) / float(height)
+
+            if rotate and exif is not None:
+                transpose = cls._orientation_transposes.get(
+                    _exif_orientation(exif))
+            else:
+                transpose = None
+
+            # The sizes to shrink to, as stored before rotating, None
+            # keeps the full size. Resize before rotating because the cap
+            # of the main copy is only based on the stored width.
+            if max_width is not None and width > max_width:
+                main_size = (max_width, max(1, int(max_width /
+                                                   aspect_ratio)))
+            else:
+                main_size = None
+            if main_size is None and transpose is None:
+                images = [(None, img.size)]
+            else:
+                images = [None]
+            targets = [(0, main_size)]
+
+            swapped = transpose in (Image.TRANSPOSE, Image.TRANSVERSE,
+                                    Image.ROTATE_90, Image.ROTATE_270)
+            main_width = (main_size or img.size)[1 if swapped else 0]
+            for i, derivative_width in enumerate(widths):
+                if swapped:
+                    size = (max(1, int(derivative_width * aspect_ratio)),
+                            derivative_width)
+                else:
+                    size = (derivative_width,
+                            max(1, int(derivative_width / aspect_ratio)))
+                images.append(None)
+                if derivative_width != main_width and size[0] < width:
+                    targets.append((i + 1, size))
+
+            if images[0] is not None:
+                # The main copy is the original file.
+                targets = targets[1:]
+            if not targets:
+                return images
+
+            # Largest first, so each copy is shrunk from the one before.
+            targets.sort(key=lambda target: -(target[1] or img.size)[0])
+
+            largest = targets[0][1]
+            if largest is not None:
+                img.draft(img.mode, (2 * largest[0], 2 * largest[1]))
+
+            # The decoded pixels, twice over while a full size image is
+            # transposed.
+            num_bytes = img.size[0] * img.size[1] * len(img.getbands())
+            if transpose is not None and largest is None:
+                num_bytes *= 2
+
+            with _reserve_decode(decode_budget, num_bytes):
+                img.load()
+
+                for index, size in targets:
+                    if size is not None:
+                        img.thumbnail(size, Image.ANTIALIAS)
+
+                    if transpose is not None:
+                        upright = img.transpose(transpose)
+                    else:
+                        upright = img
+
+                    buf = io.BytesIO()
+
+                    if img_format == 'JPEG':
+                        save_kwargs = {}
+                        if exif is not None:
+                            save_kwargs['exif'] = _update_exif(
+                                exif, upright.size, transpose is not None)
+                        if icc_profile is not None:
+                            save_kwargs['icc_profile'] = icc_profile
+                        upright.save(buf, img_format, **save_kwargs)
+                        # PIL only writes the Exif segment, so the IPTC
+                        # (APP13), XMP (the other APP1s) and comment
+                        # segments are copied over as is.
+                        data = _insert_jpeg_segments(buf.getvalue(), [
+                            segment for marker, segment in segments if
+                            marker in (0xED, 0xFE) or
+                            (marker == 0xE1 and
+                             segment[4:10] != b'Exif\x00\x00')])
+                    else:
+                        upright.save(buf, img_format)
+                        data = buf.getvalue()
+
+                    images[index] = (data, upright.size)
+
+        return images
+
+    @classmethod
+    def rotate_image(cls, file_path):
         """Rotate and image to the correct orienation based on the EXIF
         orientation data.
 
@@ -323,16 +3543,10 @@ class ImageUploader(object):
             The path to the image file.
 
         """
-        # -ft : sets the filesystem timestamp to the Exif timestamp
-        # -autorot : rotates the image so it is upright and then sets the
-        # orientation tag to 1
-        os.system("jhead -q -ft -autorot {}".format(file_path))
+        cls.normalize_image(file_path, file_path, max_width=None)
 
-        # TODO : Change this to a PIL call?:
-        # http://stackoverflow.com/questions/4228530/pil-thumbnail-is-rotating-my-image
-
-    @staticmethod
-    def resize_image_to_1024(parent_file_path, file_path):
+    @classmethod
+    def resize_image_to_1024(cls, parent_file_path, file_path):
         """Resizes the image to 1024 if it is larger in width.
 
         Parameters
@@ -344,31 +3558,13 @@ class ImageUploader(object):
 
         Notes
         =====
-        Do this before rotating the image because it is only based on width.
+        The resized image is decoded from the parent file and it isn't
+        rotated, use normalize_image to do both in one pass.
 
         """
-        img = Image.open(file_path)
-        width, height = img.size
-        aspect_ratio = float(width) / float(height)
-        max_width = 1024
-        if width > max_width:
-
-            reduced_size = max_width, int(max_width / aspect_ratio)
-            img.thumbnail(reduced_size, Image.ANTIALIAS)
-            img.save(file_path, img.format)
-
-            # Copy all metadata from parent file to the resized file
-            os.system('jhead -q -te {} {}'.format(parent_file_path, file_path))
-
-            metadata = GExiv2.Metadata(file_path)
-            if (metadata.get_pixel_width() != reduced_size[0] or
-                metadata.get_pixel_height() != reduced_size[1]):
-
-                metadata.set_pixel_width(reduced_size[0])
-                metadata.set_pixel_height(reduced_size[1])
-                metadata.save_file()
+        cls.normalize_image(parent_file_path, file_path, rotate=False)
 
-    def upload_image(self, page, file_path):
+    def upload_image(self, page, file_path, data=None, file_name=None):
         """Uploads the image to the server and associates it with the given
         page.
 
@@ -378,21 +3574,41 @@ class ImageUploader(object):
             The response dictionary for a page.
         file_path : string
             The path to the image file.
+        data : bytes, optional, default=None
+            If given, these contents are uploaded instead of the file's,
+            under the file's name.
+        file_name : string, optional, default=None
+            The name to upload the file under, the name of the file if
+            None.
 
         """
 
-        with open(file_path, 'r') as image:
+        with self.metrics.stage('upload_image'):
+            print('Uploading {} to the {} page'.format(file_path, page['name']))
 
-            print('Uploading {} to the {} page'.format(file_path,
-                                                       page['name']))
+            if file_name is None:
+                file_name = os.path.split(file_path)[1]
+
+            if data is None:
+                with open(file_path, 'rb') as image:
+                    self._post_file(page, file_name, image)
+            else:
+                self._post_file(page, file_name, io.BytesIO(data))
+
+            self.file_index.add(file_name, page['slug'])
+            self.hash_index.record_post(page['slug'], file_name)
 
-            self.api.file.post({'name': os.path.split(file_path)[1],
-                                'slug': page['slug']},
-                               files={'file': image},
-                               username=self.user_name,
-                               api_key=self.api_key)
             print('Done.')
 
+    def _post_file(self, page, file_name, image):
+        """Posts the open image file to the page under the given name."""
+
+        self.api.file.post({'name': file_name,
+                            'slug': page['slug']},
+                           files={'file': (file_name, image)},
+                           username=self.user_name,
+                           api_key=self.api_key)
+
     def embed_image(self, page_name, image_name, image_aspect_ratio,
                     caption='Caption me!'):
         """Appends HTML to the page that embeds the attached image.
@@ -414,35 +3630,361 @@ class ImageUploader(object):
             The response from the patch.
 
         """
-        files = self.find_files_in_page(page_name)
-        page_info = self.api.page(page_name).get()
+        return self.embed_images(page_name, [(image_name, image_aspect_ratio,
+                                              caption)])
+
+    def embed_images(self, page_name, images):
+        """Appends HTML to the page that embeds each of the attached images,
+        with a single patch.
+
+        Parameters
+        ==========
+        page_name : string
+            The name of the page to embed the images too.
+        images : list of tuples
+            A tuple of the image name, the aspect ratio of the rotated image
+            and the caption for each image, see embed_image, optionally
+            followed by the variants of the image, see image_html.
+
+        Returns
+        =======
+        page_response : dictionary
+            The page after the patch, or None if no images were embedded.
+
+        """
+        with self.metrics.stage('embed_images'):
+            # Get the latest content so that edits made since the page was
+            # cached aren't overwritten.
+            page_info = self.page_cache.get(page_name, fresh=True)
+            files = self.find_files_in_page(page_name)
+            file_names = [f['name'] for f in files]
+
+            current_content = page_info['content']
+            new_content = current_content
+
+            for image in images:
+                image_name = image[0]
+                html = self.image_html(*image)
+                if image_name in file_names and html not in new_content:
+                    new_content += html
+                else:
+                    print('Aborting image not embedding, do it manually.')
+
+            if new_content != current_content:
+                changes = {'content': new_content}
+                response = self.api.page(page_name).patch(changes,
+                    username=self.user_name, api_key=self.api_key)
+                return self.page_cache.update(page_name, response, changes)
+            else:
+                return None
+
+    @staticmethod
+    def image_html(image_name, image_aspect_ratio, caption, variants=()):
+        """Returns the HTML that embeds an attached image in a page.
+
+        Parameters
+        ==========
+        image_name : string
+            The name of an image that is attached to the page.
+        image_aspect_ratio : float
+            The ratio of width to height of the rotated image.
+        caption : string
+            The caption that is displayed under the image.
+        variants : list of tuples, optional, default=()
+            The (name, width) of each attached copy of the image in
+            different sizes, including the image itself. If given, the
+            smallest copy that fills the thumbnail is shown and the
+            browser picks among all of them with srcset.
+
+        """
 
         thumbnail_width = 300  # pixels
         thumbnail_height = int(thumbnail_width / image_aspect_ratio)
 
-        current_content = page_info['content']
+        if variants:
+            variants = sorted(variants, key=lambda variant: variant[1])
+            image_name = ([name for name, width in variants if width >=
+                           thumbnail_width] or [variants[-1][0]])[0]
+            srcset = ' srcset="{}" sizes="{}px"'.format(', '.join(
+                '_files/{} {}w'.format(name, width) for name, width in
+                variants), thumbnail_width)
+        else:
+            srcset = ''
+
         # TODO: Rotated images seem to have confused exifs on the web site.
-        html = \
+        return \
 """
 <p>
   <span class="image_frame image_frame_border">
-    <img src="_files/{}" style="width: 300px; height: {}px;" />
+    <img src="_files/{}"{} style="width: 300px; height: {}px;" />
     <span class="image_caption" style="width: 300px;">
       {}
     </span>
   </span>
 </p>
-""".format(image_name, thumbnail_height, caption)
+""".format(image_name, srcset, thumbnail_height, caption)
 
-        if (image_name in [f['name'] for f in files] and html not
-                in current_content):
-            self.api.page(page_name).patch({'content':
-                current_content + html}, username=self.user_name,
-                api_key=self.api_key)
-            return self.api.page(page_name).get()
+
+class MultiWikiUploader(object):
+    """Uploads the tagged images in a set of directories to several
+    LocalWikis, e.g. regional mirrors. The directories are scanned and the
+    images resized and rotated once, then the prepared images are uploaded
+    to all of the wikis at the same time. Each wiki has its own
+    ImageUploader, so its own credentials, page keyword prefix, concurrency
+    and journal. The progress of each wiki is kept in status."""
+
+    # The number of images prepared at a time. The next batch is prepared
+    # while the wikis upload the current one, so at most two batches of
+    # prepared images exist at once.
+    _batch_size = 100
+
+    def __init__(self, targets, scan_index_path=None, metrics=None):
+        """Initializes an ImageUploader for each wiki.
+
+        Parameters
+        ==========
+        targets : list of dictionaries
+            One dictionary per wiki with its 'api_url' and optionally a
+            'name' for the status (the url by default), the
+            'page_keyword_prefix' of its page keywords and the
+            'concurrency' of its uploads (by default those given to
+            upload). The other items are passed to ImageUploader, e.g.
+            'user_name', 'api_key', 'journal_path' or 'rate_limit'.
+        scan_index_path : string, optional, default=None
+            The scan index of the directories, see ImageUploader.
+        metrics : RunMetrics, optional, default=None
+            Where the time spent scanning and preparing the images is
+            recorded. Each wiki's uploader records its own API calls.
+
+        """
+
+        if not targets:
+            raise ValueError('At least one target wiki is needed.')
+
+        if metrics is None:
+            self.metrics = RunMetrics()
         else:
-            print('Aborting image not embedding, do it manually.')
-            return None
+            self.metrics = metrics
+
+        self.targets = []
+        self.status = collections.OrderedDict()
+
+        for i, target in enumerate(targets):
+            target = dict(target)
+            api_url = target.pop('api_url')
+            name = target.pop('name', api_url)
+            if name in self.status:
+                raise ValueError('The target {} is given twice.'.format(name))
+            prefix = target.pop('page_keyword_prefix', None)
+            concurrency = target.pop('concurrency', None)
+            if i == 0:
+                # The first wiki's uploader scans and hashes the images for
+                # all of them.
+                target['scan_index_path'] = scan_index_path
+            self.targets.append({'name': name,
+                                 'uploader': ImageUploader(api_url, **target),
+                                 'page_keyword_prefix': prefix,
+                                 'concurrency': concurrency})
+            self.status[name] = {'images': 0, 'done': 0, 'failed': 0,
+                                 'seconds': 0.0, 'error': None}
+
+    def upload(self, main_keyword, *directories, **kwargs):
+        """Uploads the tagged images in the directories to all of the
+        wikis.
+
+        Parameters
+        ==========
+        main_keyword : string
+            The keyword that marks the images for the wikis, see
+            ImageUploader.upload.
+        directories : string
+            The paths to directories to search for images.
+        page_keyword_prefix : string, optional, default="page:"
+            The prefix of the page keywords for the wikis that don't have
+            their own.
+        concurrency : integer, optional, default=1
+            The concurrency of the uploads to the wikis that don't have
+            their own.
+        batch_size : integer, optional, default=100
+            The number of images prepared at a time.
+
+        The processes, memory_budget, in_memory, derivative_widths,
+        scan_workers, recursive, include and exclude keyword arguments are
+        the same as for ImageUploader.upload. The images are prepared by processes
+        processes once for all of the wikis.
+
+        """
+
+        start = time.time()
+
+        processes = kwargs.get('processes', 1)
+        in_memory = kwargs.get('in_memory', False)
+        batch_size = kwargs.get('batch_size', self._batch_size)
+        derivative_widths = kwargs.get('derivative_widths', [])
+
+        for target in self.targets:
+            target_kwargs = dict(kwargs, processes=1)
+            if target['page_keyword_prefix'] is not None:
+                target_kwargs['page_keyword_prefix'] = \
+                    target['page_keyword_prefix']
+            if target['concurrency'] is not None:
+                target_kwargs['concurrency'] = target['concurrency']
+            target['uploader']._configure(main_keyword, directories,
+                                          target_kwargs)
+
+        scanner = self.targets[0]['uploader']
+        with self.metrics.stage('scan'):
+            scanner.find_localwiki_images()
+        records = scanner.image_records
+
+        # Each wiki reads its own page keywords from the scanned keywords.
+        target_images = []
+        for target in self.targets:
+            uploader = target['uploader']
+            uploader.image_records = records
+            wiki_images = {}
+            for file_path, record in records.items():
+                page_names = uploader.parse_keywords(
+                    record.keywords, uploader.page_keyword_prefix)[0]
+                if page_names:
+                    wiki_images[file_path] = (page_names, record.template)
+            target_images.append(wiki_images)
+
+        with self.metrics.stage('deduplicate'):
+            hashes = scanner.content_hashes(
+                set(itertools.chain.from_iterable(target_images)))
+
+        # Each wiki is deduplicated against its own hash index once, and
+        # counts its uploads to each page down over all of the batches, so
+        # that each page is patched once.
+        target_remaining = []
+        for i, target in enumerate(self.targets):
+            target_images[i], remaining_uploads = \
+                target['uploader']._start_upload(target_images[i],
+                                                 hashes=hashes)
+            target_remaining.append(remaining_uploads)
+            self.status[target['name']].update(
+                {'images': len(target_images[i]), 'done': 0, 'failed': 0,
+                 'seconds': 0.0, 'error': None})
+
+        file_paths = sorted(set(itertools.chain.from_iterable(
+            target_images)))
+        batches = list(_chunks(file_paths, batch_size))
+
+        def prepare(batch):
+            return process_pool.map_async(
+                _prepare_image, [(file_path, in_memory, records[file_path],
+                                  derivative_widths) for file_path in batch])
+
+        def upload_batch(args):
+            target, wiki_images, remaining_uploads, prepared = args
+            if not wiki_images:
+                return
+            status = self.status[target['name']]
+            batch_start = time.time()
+            try:
+                target['uploader']._upload_batch(wiki_images,
+                                                 remaining_uploads, prepared)
+            except Exception as error:
+                # The other wikis carry on, the images are uploaded to this
+                # one on the next run.
+                print("Failed to upload to {}: {}".format(target['name'], error))
+                status['failed'] += len(wiki_images)
+                status['error'] = str(error)
+            else:
+                status['done'] += len(wiki_images)
+            status['seconds'] += time.time() - batch_start
+
+        def finish(target):
+            status = self.status[target['name']]
+            finish_start = time.time()
+            try:
+                target['uploader']._finish_upload(
+                    failed=status['failed'] > 0)
+            except Exception as error:
+                print("Failed to embed the images in {}: {}".format(target['name'], error))
+                status['error'] = str(error)
+            status['seconds'] += time.time() - finish_start
+
+        memory_budget = kwargs.get('memory_budget', None)
+        if memory_budget is None:
+            decode_budget = None
+        else:
+            decode_budget = DecodeBudget(memory_budget * processes)
+
+        process_pool = multiprocessing.Pool(processes,
+                                            initializer=_init_worker,
+                                            initargs=(decode_budget,))
+        thread_pool = ThreadPool(len(self.targets))
+
+        try:
+            pending = prepare(batches[0]) if batches else None
+            for i, batch in enumerate(batches):
+
+                with self.metrics.stage('prepare_images'):
+                    results = pending.get()
+                if i + 1 < len(batches):
+                    pending = prepare(batches[i + 1])
+
+                prepared = {}
+                for file_path, (result, stages) in zip(batch, results):
+                    self.metrics.merge_stages(stages)
+                    prepared[file_path] = result
+
+                thread_pool.map(upload_batch, [
+                    (target, dict((file_path, wiki_images[file_path]) for
+                                  file_path in batch if file_path in
+                                  wiki_images), remaining_uploads, prepared)
+                    for target, wiki_images, remaining_uploads in
+                    zip(self.targets, target_images, target_remaining)])
+
+                # The next batch is being prepared in the same temporary
+                # directories, so only this batch's images are removed.
+                for file_path, result in prepared.items():
+                    tmp_paths = [result[0]] + [derivative[2] for derivative
+                                               in result[5]]
+                    for tmp_path in tmp_paths:
+                        if tmp_path != file_path and os.path.exists(tmp_path):
+                            os.remove(tmp_path)
+
+                print(self.report_status())
+
+            thread_pool.map(finish, self.targets)
+        finally:
+            process_pool.close()
+            thread_pool.close()
+            process_pool.join()
+            thread_pool.join()
+
+        print('Cleaning up temporary images.')
+        scanner.remove_tmp_dirs(file_paths)
+
+        self.metrics.record_stage('upload', time.time() - start)
+
+        print('Done.')
+
+    def report_status(self):
+        """Returns a line per wiki with the number of images it has been
+        sent out of those it needs, the files uploaded to it, the images
+        that failed and the last error."""
+
+        lines = []
+        for target in self.targets:
+            status = self.status[target['name']]
+            api_calls = target['uploader'].metrics.api_calls
+            uploaded = sum(count for (method, endpoint, code), count in
+                           api_calls.items() if method == 'POST' and
+                           endpoint == 'file' and code < 300)
+            line = '{}: {}/{} images done, {} files uploaded, {} failed, ' \
+                '{:.1f} s'.format(target['name'], status['done'],
+                                  status['images'], uploaded,
+                                  status['failed'], status['seconds'])
+            if status['error'] is not None:
+                line += ', last error: {}'.format(status['error'])
+            lines.append(line)
+
+        return '\n'.join(lines)
+
 
 if __name__ == "__main__":
 
@@ -467,11 +4009,93 @@ if __name__ == "__main__":
     parser.add_argument('--apikey', type=str, default=None,
         help="The api key for API access.")
 
+    parser.add_argument('--processes', type=int, default=1,
+        help="The number of processes used to resize and rotate images.")
+
+    parser.add_argument('--concurrency', type=int, default=1,
+        help="The maximum number of simultaneous requests to the server.")
+
+    parser.add_argument('--max-pending', type=int, default=None,
+        help="The maximum number of prepared images waiting for upload.")
+
+    parser.add_argument('--memory-budget', type=int, default=None,
+        help="The megabytes of decoded images each process may hold.")
+
+    parser.add_argument('--derivative-width', type=int, action='append',
+        default=[],
+        help="Also upload a copy of each image this wide, can be repeated.")
+
+    parser.add_argument('--recursive', action='store_true',
+        help="Search the subdirectories of the directories too.")
+
+    parser.add_argument('--include', type=str, action='append', default=[],
+        help="Only upload images matching this glob, can be repeated.")
+
+    parser.add_argument('--exclude', type=str, action='append', default=[],
+        help="Skip files and directories matching this glob, can be repeated.")
+
+    parser.add_argument('--scan-workers', type=int, default=1,
+        help="The number of threads used to read image keywords.")
+
+    parser.add_argument('--scan-index', type=str, default=None,
+        help="An SQLite file to remember the tags of scanned photos in.")
+
+    parser.add_argument('--in-memory', action='store_true',
+        help="Process images in memory instead of in temporary files.")
+
+    parser.add_argument('--journal', type=str, default=None,
+        help="An SQLite file that lets an interrupted upload be resumed.")
+
+    parser.add_argument('--hash-index', type=str, default=None,
+        help="An SQLite file that remembers which photos were uploaded, "
+             "the default is ~/.localwiki-hashes-<host>.db.")
+
+    parser.add_argument('--no-hash-index', action='store_true',
+        help="Only recognize copies of photos within this run.")
+
+    parser.add_argument('--rate-limit', type=float, default=None,
+        help="The maximum number of requests per second to the server.")
+
+    parser.add_argument('--retries', type=int, default=5,
+        help="The number of times a failed request is retried.")
+
+    parser.add_argument('--file-index', type=str, default=None,
+        help="A JSON file to cache the server's file listing between runs.")
+
+    parser.add_argument('--watch', action='store_true',
+        help="Keep watching the directories and upload newly tagged images.")
+
+    parser.add_argument('--debounce', type=float, default=2.0,
+        help="The seconds a changed file must be left alone before upload.")
+
+    parser.add_argument('--poll-interval', type=float, default=5.0,
+        help="The seconds between checks for changes without inotify.")
+
+    parser.add_argument('--plan', type=str, default=None,
+        help="Write what an upload would do to this JSON file and stop.")
+
+    parser.add_argument('--execute-plan', type=str, default=None,
+        help="Upload exactly what a plan written with --plan says.")
+
+    parser.add_argument('--report', type=str, default=None,
+        help="A file to write the timings and API call counts of the run to.")
+
+    parser.add_argument('--report-format', type=str, default='json',
+        choices=['json', 'prometheus'],
+        help="The format of the report file, the default is json.")
+
+    parser.add_argument('--targets', type=str, default=None,
+        help="A config file with a section per wiki to upload to at once.")
+
     parser.add_argument('directories', type=str, nargs='*',
         help="The directories to search.")
 
     args = parser.parse_args()
 
+    if args.targets and (args.plan or args.execute_plan or args.watch):
+        parser.error("--targets can't be combined with --plan, "
+                     "--execute-plan or --watch.")
+
     if not args.keyword:
         config = ConfigParser.ConfigParser()
         config.read('test.cfg')
@@ -498,5 +4122,96 @@ if __name__ == "__main__":
         if args.prefix:
             upload_kwargs.update({'page_keyword_prefix': args.prefix})
 
-    uploader = ImageUploader(api_url, **init_kwargs)
-    uploader.upload(main_keyword, *args.directories, **upload_kwargs)
+    if args.file_index:
+        init_kwargs.update({'file_index_path': args.file_index})
+
+    if args.scan_index:
+        init_kwargs.update({'scan_index_path': args.scan_index})
+
+    if args.journal:
+        init_kwargs.update({'journal_path': args.journal})
+
+    if args.no_hash_index:
+        init_kwargs.update({'hash_index_path': None})
+    elif args.hash_index:
+        init_kwargs.update({'hash_index_path': args.hash_index})
+    elif api_url:
+        init_kwargs.update({'hash_index_path':
+                            default_hash_index_path(api_url)})
+
+    init_kwargs.update({'rate_limit': args.rate_limit,
+                        'retries': args.retries})
+
+    if args.max_pending:
+        upload_kwargs.update({'max_pending': args.max_pending})
+
+    if args.memory_budget:
+        upload_kwargs.update({'memory_budget': args.memory_budget})
+
+    upload_kwargs.update({'processes': args.processes,
+                          'concurrency': args.concurrency,
+                          'scan_workers': args.scan_workers,
+                          'in_memory': args.in_memory,
+                          'derivative_widths': args.derivative_width,
+                          'recursive': args.recursive,
+                          'include': args.include,
+                          'exclude': args.exclude})
+
+    if args.targets:
+        targets_config = ConfigParser.ConfigParser()
+        targets_config.read(args.targets)
+        targets = []
+        for section in targets_config.sections():
+            target = {'name': section, 'rate_limit': args.rate_limit,
+                      'retries': args.retries}
+            target.update(targets_config.items(section))
+            for key in ('concurrency', 'retries', 'pool_size'):
+                if key in target:
+                    target[key] = int(target[key])
+            if target['rate_limit'] is not None:
+                target['rate_limit'] = float(target['rate_limit'])
+            if args.no_hash_index:
+                target['hash_index_path'] = None
+            elif 'hash_index_path' not in target:
+                target['hash_index_path'] = default_hash_index_path(
+                    target['api_url'])
+            targets.append(target)
+        uploader = MultiWikiUploader(targets,
+                                     scan_index_path=args.scan_index)
+    else:
+        uploader = ImageUploader(api_url, **init_kwargs)
+
+    if args.targets:
+        uploader.upload(main_keyword, *args.directories, **upload_kwargs)
+    elif args.plan:
+        plan = uploader.plan(main_keyword, *args.directories,
+                             **upload_kwargs)
+        with open(args.plan, 'w') as f:
+            json.dump(plan, f, indent=2, sort_keys=True)
+        print("Wrote the plan for {} images to {}.".format(
+            len(plan['images']), args.plan))
+    elif args.execute_plan:
+        with open(args.execute_plan) as f:
+            plan = json.load(f)
+        uploader.execute_plan(plan, **upload_kwargs)
+    elif args.watch:
+        upload_kwargs.update({'debounce': args.debounce,
+                              'poll_interval': args.poll_interval})
+        uploader.watch(main_keyword, *args.directories, **upload_kwargs)
+    else:
+        uploader.upload(main_keyword, *args.directories, **upload_kwargs)
+
+    print(uploader.metrics.report())
+
+    if args.targets:
+        for target in uploader.targets:
+            print('')
+            print('{}:'.format(target['name']))
+            print(target['uploader'].metrics.report())
+
+    if args.report:
+        with open(args.report, 'w') as f:
+            if args.report_format == 'prometheus':
+                f.write(uploader.metrics.to_prometheus())
+            else:
+                f.write(uploader.metrics.to_json())